@@ -15,27 +15,62 @@
 
 """Python script generates a Google ID token based on the input payload"""
 
+import argparse
 import base64
+import errno
+import hashlib
 import httplib
 import json
-import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
 import time
 import urllib
+from multiprocessing.pool import ThreadPool
 
-import oauth2client.crypt
-import googleapiclient.discovery
 from oauth2client.service_account import ServiceAccountCredentials
-from oauth2client.client import GoogleCredentials
 
-def generate_jwt(args):
-    """Generates a signed JSON Web Token using a service account. Based on https://cloud.google.com/endpoints/docs/service-to-service-auth"""
-    # Make sure the service account has "Service Account Token Creator" permissions in Google IAM
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-      args.service_account_file).create_scoped(['https://www.googleapis.com/auth/cloud-platform'])
+IAM_HOST = "iam.googleapis.com"
+SIGN_BLOB_PATH = "/v1/projects/-/serviceAccounts/{}:signBlob"
+TOKEN_HOST = "www.googleapis.com"
+TOKEN_PATH = "/oauth2/v4/token"
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "endpoints-tools", "id-tokens")
 
-    service = googleapiclient.discovery.build(
-        serviceName='iam', version='v1', credentials=credentials)
+# Cached tokens expiring within this many seconds are fetched again
+EXPIRY_MARGIN_SECS = 300
 
+# Persistent HTTPS connections of the calling thread, keyed by host
+_connections = threading.local()
+
+def request(host, method, path, body, headers):
+    """Sends a request over the persistent connection of the calling thread.
+
+    The connection is reopened once if the server closed it since the last
+    request.
+    """
+    if not hasattr(_connections, "hosts"):
+        _connections.hosts = {}
+    for attempt in range(2):
+        conn = _connections.hosts.get(host)
+        if conn is None:
+            conn = _connections.hosts[host] = httplib.HTTPSConnection(host)
+        try:
+            conn.request(method, path, body, headers)
+            res = conn.getresponse()
+            return res.status, res.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            del _connections.hosts[host]
+            if attempt:
+                raise
+
+def generate_jwt(credentials, access_token, aud, issuer):
+    """Generates a signed JSON Web Token using a service account. Based on https://cloud.google.com/endpoints/docs/service-to-service-auth"""
+    # Make sure the service account has "Service Account Token Creator" permissions in Google IAM
     now = int(time.time())
     header_json = json.dumps({
         "typ": "JWT",
@@ -44,35 +79,128 @@ def generate_jwt(args):
     payload_json = json.dumps({
         'iat': now,
         "exp": now + 3600,
-        'iss': args.issuer if args.issuer else credentials.service_account_email,
-        "target_audience": 'https://' + args.aud,
+        'iss': issuer if issuer else credentials.service_account_email,
+        "target_audience": 'https://' + aud,
         "aud": "https://www.googleapis.com/oauth2/v4/token"
     })
 
     header_and_payload = '{}.{}'.format(
         base64.urlsafe_b64encode(header_json),
         base64.urlsafe_b64encode(payload_json))
-    slist = service.projects().serviceAccounts().signBlob(
-        name="projects/-/serviceAccounts/" + credentials.service_account_email,
-        body={'bytesToSign': base64.b64encode(header_and_payload)})
-    res = slist.execute()
+    status, data = request(
+        IAM_HOST, "POST",
+        SIGN_BLOB_PATH.format(credentials.service_account_email),
+        json.dumps({'bytesToSign': base64.b64encode(header_and_payload)}),
+        {"Authorization": "Bearer {}".format(access_token),
+         "Content-Type": "application/json"})
+    if status != 200:
+        raise RuntimeError("signBlob failed (status code {}): {}".format(
+            status, data))
     signature = base64.urlsafe_b64encode(
-        base64.decodestring(res['signature']))
+        base64.decodestring(json.loads(data)['signature']))
     signed_jwt = '{}.{}'.format(header_and_payload, signature)
 
     return signed_jwt
 
-def main(args):
+def fetch_id_token(credentials, access_token, aud, issuer):
     """Request a Google ID token using a JWT."""
     params = urllib.urlencode({
         'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
-        'assertion': generate_jwt(args)})
+        'assertion': generate_jwt(credentials, access_token, aud, issuer)})
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    conn = httplib.HTTPSConnection("www.googleapis.com")
-    conn.request("POST", "/oauth2/v4/token", params, headers)
-    res = json.loads(conn.getresponse().read())
-    conn.close()
-    return res['id_token']
+    status, data = request(TOKEN_HOST, "POST", TOKEN_PATH, params, headers)
+    if status != 200:
+        raise RuntimeError("Token request failed (status code {}): {}".format(
+            status, data))
+    return json.loads(data)['id_token']
+
+def token_expiry(token):
+    """Returns the exp claim of a JWT, or 0 if it cannot be decoded."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 0
+
+def cache_path(cache_dir, service_account_email, aud, issuer):
+    key = hashlib.sha256("\n".join(
+        [service_account_email, aud, issuer or ""])).hexdigest()
+    return os.path.join(cache_dir, key)
+
+def read_cached_token(path):
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+    except IOError:
+        return None
+    if token_expiry(token) - time.time() < EXPIRY_MARGIN_SECS:
+        return None
+    return token
+
+def write_cached_token(path, token):
+    """Atomically replaces the cached token, readable by the owner only.
+
+    Caching is best effort: if the cache directory is not writable, a
+    warning is printed to stderr and the token is not cached.
+    """
+    cache_dir = os.path.dirname(path)
+    tmp_path = None
+    try:
+        try:
+            os.makedirs(cache_dir, 0700)
+        except OSError as err:
+            # Another job may have created it first
+            if err.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        sys.stderr.write("Warning: cannot cache ID token in {}: {}\n".format(
+            cache_dir, err))
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def main(args):
+    """Returns Google ID tokens for all audiences, in the order given."""
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(
+      args.service_account_file).create_scoped(['https://www.googleapis.com/auth/cloud-platform'])
+    email = credentials.service_account_email
+
+    tokens = {}
+    if not args.no_cache:
+        for aud in args.aud:
+            token = read_cached_token(
+                cache_path(args.cache_dir, email, aud, args.issuer))
+            if token:
+                tokens[aud] = token
+
+    missing = [aud for aud in set(args.aud) if aud not in tokens]
+    if missing:
+        access_token = credentials.get_access_token().access_token
+        fetch = lambda aud: fetch_id_token(
+            credentials, access_token, aud, args.issuer)
+        if len(missing) == 1:
+            fetched = [fetch(missing[0])]
+        else:
+            pool = ThreadPool(min(len(missing), args.concurrency))
+            try:
+                fetched = pool.map(fetch, missing)
+            finally:
+                pool.close()
+                pool.join()
+        for aud, token in zip(missing, fetched):
+            tokens[aud] = token
+            if not args.no_cache:
+                write_cached_token(
+                    cache_path(args.cache_dir, email, aud, args.issuer), token)
+
+    return "\n".join(tokens[aud] for aud in args.aud)
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
@@ -81,12 +209,21 @@ if __name__ == '__main__':
   # positional arguments
   parser.add_argument(
       "aud",
+      nargs="+",
       help="Audience . This must match 'audience' in the security configuration"
-      " in the swagger spec. It can be any string")
+      " in the swagger spec. It can be any string. If several audiences are"
+      " given, their tokens are fetched concurrently and printed one per line")
   parser.add_argument(
         'service_account_file',
         help='The path to your service account json file.')
 
   #optional arguments
   parser.add_argument("-iss", "--issuer", help="Issuer claim. This will also be used for sub claim")
+  parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR,
+      help="Directory of cached ID tokens, keyed by service account and"
+      " audience. Cached tokens are reused until shortly before they expire")
+  parser.add_argument("--no_cache", action="store_true",
+      help="Always fetch new ID tokens and do not cache them")
+  parser.add_argument("--concurrency", type=int, default=8,
+      help="Maximum number of audiences fetched at the same time")
   print main(parser.parse_args())
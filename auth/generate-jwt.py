@@ -16,40 +16,123 @@
 """Python script generates a signed JWT token based on the input payload"""
 
 import argparse
+import json
+import multiprocessing
+import sys
 import time
 
 import oauth2client.crypt
 from oauth2client.service_account import ServiceAccountCredentials
 
-def main(args):
-  """Generates a signed JSON Web Token using a Google API Service Account."""
-  credentials = ServiceAccountCredentials.from_json_keyfile_name(
-      args.service_account_file)
+# Credentials and default claims of a batch worker process, set once per
+# process by init_batch_worker.
+_worker_credentials = None
+_worker_defaults = None
 
+def make_payload(credentials, claims):
+  """Builds the JWT payload from the claims, filling in exp, iat, iss and sub."""
   now = int(time.time())
 
   payload = {
         "exp": now + credentials.MAX_TOKEN_LIFETIME_SECS,
         "iat": now,
-        "aud": args.aud,
     }
 
-  if args.email:
-    payload["email"] = args.email
-  if args.groupId:
-    payload["groupId"] = args.groupId
+  for claim, value in claims.items():
+    if value is not None and claim != "iss":
+      payload[claim] = value
 
-  if args.issuer:
-    payload["iss"] = args.issuer
-    payload["sub"] = args.issuer
+  issuer = claims.get("iss")
+  if issuer:
+    payload["iss"] = issuer
+    payload["sub"] = issuer
   else:
     payload["iss"] = credentials.service_account_email
     payload["sub"] = credentials.service_account_email
 
-  signed_jwt = oauth2client.crypt.make_signed_jwt(
+  return payload
+
+def sign(credentials, payload):
+  return oauth2client.crypt.make_signed_jwt(
         credentials._signer, payload, key_id=credentials._private_key_id)
 
-  return signed_jwt
+def default_claims(args):
+  return {
+      "aud": args.aud,
+      "email": args.email,
+      "groupId": args.groupId,
+      "iss": args.issuer,
+    }
+
+def main(args):
+  """Generates a signed JSON Web Token using a Google API Service Account."""
+  credentials = ServiceAccountCredentials.from_json_keyfile_name(
+      args.service_account_file)
+
+  return sign(credentials, make_payload(credentials, default_claims(args)))
+
+def read_claim_templates(f, count):
+  """Yields claims from JSON object lines, each repeated count times.
+
+  Every "{n}" in a string claim is replaced with the repetition number, so
+  that a single template can produce many distinct tokens.
+  """
+  for line in f:
+    line = line.strip()
+    if not line:
+      continue
+    template = json.loads(line)
+    for n in xrange(count):
+      claims = {}
+      for claim, value in template.items():
+        if isinstance(value, basestring):
+          value = value.replace("{n}", str(n))
+        claims[claim] = value
+      yield claims
+
+def init_batch_worker(service_account_file, defaults):
+  global _worker_credentials, _worker_defaults
+  _worker_credentials = ServiceAccountCredentials.from_json_keyfile_name(
+      service_account_file)
+  _worker_defaults = defaults
+
+def sign_batch_claims(claims):
+  merged = dict(_worker_defaults)
+  merged.update(claims)
+  return sign(_worker_credentials, make_payload(_worker_credentials, merged))
+
+def batch(args):
+  """Signs a token for every claim template, writing one token per line."""
+  if args.batch == "-":
+    templates = sys.stdin
+  else:
+    templates = open(args.batch)
+
+  pool = multiprocessing.Pool(
+      args.processes,
+      initializer=init_batch_worker,
+      initargs=(args.service_account_file, default_claims(args)))
+  start = time.time()
+  tokens = 0
+  try:
+    for token in pool.imap(sign_batch_claims,
+                           read_claim_templates(templates, args.count),
+                           chunksize=args.chunksize):
+      sys.stdout.write(token + "\n")
+      tokens += 1
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    if templates is not sys.stdin:
+      templates.close()
+
+  sys.stdout.flush()
+  elapsed = time.time() - start
+  sys.stderr.write("Signed {} tokens in {:.2f}s ({:.0f} tokens/sec)\n".format(
+      tokens, elapsed, tokens / elapsed if elapsed > 0 else 0))
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
@@ -68,4 +151,23 @@ if __name__ == '__main__':
   parser.add_argument("-e", "--email", help="Email claim in JWT")
   parser.add_argument("-g", "--groupId", help="GroupId claim in JWT")
   parser.add_argument("-iss", "--issuer", help="Issuer claim. This will also be used for sub claim")
-  print main(parser.parse_args())
+
+  # batch mode arguments
+  parser.add_argument("-b", "--batch",
+      help="File with one JSON object of claims per line, or - for stdin."
+      " Signs one token per line and prints the tokens newline-delimited."
+      " Claims missing from a line default to the values given above")
+  parser.add_argument("-n", "--count", type=int, default=1,
+      help="Number of tokens per claims line in batch mode. \"{n}\" in a"
+      " string claim is replaced with the token number")
+  parser.add_argument("-p", "--processes", type=int,
+      default=multiprocessing.cpu_count(),
+      help="Number of signing processes in batch mode")
+  parser.add_argument("--chunksize", type=int, default=64,
+      help="Number of tokens handed to a signing process at a time")
+
+  args = parser.parse_args()
+  if args.batch:
+    batch(args)
+  else:
+    print main(args)
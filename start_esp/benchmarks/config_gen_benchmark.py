@@ -0,0 +1,280 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Config generation benchmark for start_esp.
+# Renders nginx.conf and server_config.pb.txt from synthetic inputs of
+# increasing size and records render time and peak memory for every case.
+# Each measurement runs in a forked child so that peak RSS is per case.
+# Templates are compiled once per case and only rendering is timed, since
+# compiling takes tens of milliseconds regardless of the input size.
+#
+# Exit codes:
+#     0 - success,
+#     1 - render time grows faster than linearly,
+#     3 - benchmark failure.
+
+import argparse
+import gc
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from mako.template import Template
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import start_esp
+
+# Directory with the nginx and server config templates
+TEMPLATE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Number of synthetic entries per case
+DEFAULT_SIZES = "10,1000,10000"
+
+# Number of renders per measurement, the best one is reported
+DEFAULT_REPEAT = 5
+
+# Maximum exponent of the render time in the number of entries. Linear
+# rendering is at about 1, quadratic rendering at about 2.
+DEFAULT_MAX_EXPONENT = 1.6
+
+
+def make_args(workdir):
+    parser = start_esp.make_argparser()
+    args = parser.parse_args([
+        '--template',
+        os.path.join(TEMPLATE_DIR, 'nginx-auto.conf.template'),
+        '--server_config_template',
+        os.path.join(TEMPLATE_DIR, 'server-auto.conf.template'),
+        '--config_dir', workdir,
+        '--pid_file', os.path.join(workdir, 'nginx.pid')])
+    args.service_configs = {}
+    args.rollout_id = "synthetic-rollout"
+    args.rollout_strategy = start_esp.DEFAULT_ROLLOUT_STRATEGY
+    start_esp.handle_xff_trusted_proxies(args)
+    start_esp.handle_dns(args)
+    return args
+
+
+def synthetic_cidr(i):
+    if i % 2:
+        return "2001:db8:%x::/48" % i
+    return "10.%d.%d.0/24" % ((i // 256) % 256, i % 256)
+
+
+def synthetic_backend(i):
+    return "10.%d.%d.%d:8081" % ((i // 65536) % 256, (i // 256) % 256, i % 256)
+
+
+def bench_xff_trusted_proxies(args, size):
+    # Parsing of the -x flag is part of the case: the list is user input
+    args.xff_trusted_proxy_list = ", ".join(
+        synthetic_cidr(i) for i in xrange(size))
+    ingress = start_esp.make_ingress(args)
+    template = Template(filename=args.template)
+    def run():
+        start_esp.handle_xff_trusted_proxies(args)
+        return start_esp.render_template(template, [ingress], args)
+    return run
+
+
+def bench_locations(args, size):
+    ingress = start_esp.make_ingress(args)
+    ingress = ingress._replace(locations=[
+        start_esp.Location(
+            path='/api%d/' % i,
+            backends=[synthetic_backend(i)],
+            proto='http')
+        for i in xrange(size)])
+    template = Template(filename=args.template)
+    def run():
+        return start_esp.render_template(template, [ingress], args)
+    return run
+
+
+def bench_backends(args, size):
+    ingress = start_esp.make_ingress(args)
+    ingress = ingress._replace(locations=[
+        start_esp.Location(
+            path='/',
+            backends=[synthetic_backend(i) for i in xrange(size)],
+            proto='http')])
+    template = Template(filename=args.template)
+    def run():
+        return start_esp.render_template(template, [ingress], args)
+    return run
+
+
+def bench_service_configs(args, size):
+    args.service_configs = dict(
+        (os.path.join(args.config_dir,
+                      start_esp.generate_service_config_filename(i)), 1)
+        for i in xrange(size))
+    template = Template(filename=args.server_config_template)
+    def run():
+        return start_esp.render_server_config_template(template, args)
+    return run
+
+
+CASES = [
+    ("xff_trusted_proxies", bench_xff_trusted_proxies),
+    ("locations", bench_locations),
+    ("backends", bench_backends),
+    ("service_configs", bench_service_configs),
+]
+
+
+def fit_exponent(results):
+    """Fits the growth of the render time as a power of the size.
+
+    The render time of the smallest size is taken as the fixed cost of a
+    render. Returns the least squares slope of the log of the time over it
+    against the log of the entries over the smallest size.
+    """
+    smallest, fixed = results[0]
+    # Clamped for clocks too coarse to time the smallest renders
+    points = [(math.log(size - smallest), math.log(max(seconds - fixed, 1e-7)))
+              for size, seconds in results[1:]]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in points) /
+            sum((x - mean_x) ** 2 for x, _ in points))
+
+
+def measure(setup, size, repeat):
+    """Runs a case in a forked child, returns (seconds, bytes, maxrss KiB)."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 0
+        try:
+            workdir = tempfile.mkdtemp(prefix="esp-bench-")
+            try:
+                run = setup(make_args(workdir), size)
+                best = None
+                for _ in xrange(repeat):
+                    # Like timeit, without collection pauses that depend on
+                    # the heap rather than the render
+                    gc.collect()
+                    gc.disable()
+                    start = time.time()
+                    conf = run()
+                    elapsed = time.time() - start
+                    gc.enable()
+                    if best is None or elapsed < best:
+                        best = elapsed
+                os.write(write_fd, "%r %d" % (best, len(conf)))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        except BaseException as err:
+            logging.error("Benchmark case failed: %s", err)
+            code = 3
+        os._exit(code)
+
+    os.close(write_fd)
+    data = ""
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    _, status, usage = os.wait4(pid, 0)
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        return None
+    seconds, output_size = data.split()
+    return float(seconds), int(output_size), usage.ru_maxrss
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description='''
+    Config generation benchmark. Renders the nginx and server config templates
+    with synthetic inputs of increasing size and reports render time, output
+    size and peak memory. Fails if the render time grows faster than the
+    allowed power of the number of entries.''')
+
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='''
+    Comma separated list of synthetic entry counts. Default value:
+    {sizes}'''.format(sizes=DEFAULT_SIZES))
+
+    parser.add_argument('--repeat', default=DEFAULT_REPEAT, type=int, help='''
+    Number of renders per measurement, the fastest one is reported.
+    Default value: {repeat}'''.format(repeat=DEFAULT_REPEAT))
+
+    parser.add_argument('--max_exponent', default=DEFAULT_MAX_EXPONENT,
+    type=float, help='''Maximum allowed exponent of the render time in the
+    number of entries. It is fitted by least squares over all sizes to the
+    time and entries added to the smallest size. Needs at least three sizes.
+    Default value: {exponent}'''.format(exponent=DEFAULT_MAX_EXPONENT))
+
+    parser.add_argument('--cases', default=None, help='''Comma separated list
+    of cases to run, one of {cases}. Default: all cases.'''.format(
+        cases=", ".join(name for name, _ in CASES)))
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = make_argparser()
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    sizes = sorted(set(int(size) for size in args.sizes.split(",")
+                       if size.strip()))
+    if sizes and sizes[0] < 1:
+        parser.error("Sizes must be positive")
+    if len(sizes) < 3:
+        logging.warning("Growth checks need at least three sizes")
+    cases = CASES
+    if args.cases is not None:
+        selected = [name.strip() for name in args.cases.split(",")]
+        cases = [case for case in CASES if case[0] in selected]
+
+    row = "{:<20} {:>8} {:>12} {:>12} {:>12} {:>10}"
+    print row.format("case", "entries", "render ms", "us/entry",
+                     "output KiB", "maxrss KiB")
+
+    exit_code = 0
+    for name, setup in cases:
+        results = []
+        for size in sizes:
+            result = measure(setup, size, args.repeat)
+            if result is None:
+                sys.exit(3)
+            seconds, output_size, maxrss = result
+            results.append((size, seconds))
+            print row.format(name, size,
+                             "%.2f" % (seconds * 1000),
+                             "%.3f" % (seconds * 1e6 / size),
+                             output_size // 1024, maxrss)
+
+        if len(results) < 3:
+            continue
+        exponent = fit_exponent(results)
+        if exponent > args.max_exponent:
+            logging.error("Render time of case {} grows faster than linearly: "
+                          "exponent {:.2f} from {} to {} entries".format(
+                              name, exponent, sizes[0], sizes[-1]))
+            exit_code = 1
+
+    sys.exit(exit_code)
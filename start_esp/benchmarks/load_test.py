@@ -0,0 +1,538 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Load test harness for the generated nginx.conf.
+# Renders nginx-auto.conf.template without the Endpoints module directives for
+# a matrix of listener protocols, upstream keepalive settings and worker
+# counts, runs a stock nginx binary in front of local stub backends and
+# reports throughput and latency percentiles for every variant.
+#
+# The "http" and "ssl" variants proxy to a stub HTTP/1.1 backend. The "http2"
+# variant proxies gRPC to a stub gRPC backend, the way ESP exposes gRPC
+# services on the HTTP/2 port, and needs the grpcio package.
+#
+# The "http2" variant runs with upstream keepalive 0 only: gRPC is passed to
+# the backend without an upstream block, so the setting does not apply.
+#
+# The "http" and "ssl" variants also run with every --gzip_levels entry, and
+# every variant reports response bytes on the wire and nginx CPU time per
+# request, which shows the cost of compression against the bytes saved.
+#
+# Exit codes:
+#     0 - success,
+#     1 - regression against the baseline,
+#     3 - setup failure.
+
+import argparse
+import BaseHTTPServer
+import collections
+import httplib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import start_esp
+
+# Directory with the nginx config template
+TEMPLATE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Stock nginx binary, must be built with the http_v2, ssl and realip modules
+DEFAULT_NGINX = "nginx"
+
+# Matrix defaults
+DEFAULT_PROTOCOLS = "http,http2,ssl"
+DEFAULT_KEEPALIVES = "0,128"
+DEFAULT_WORKERS = "1,2"
+
+# gzip compression levels, 0 disables compression
+DEFAULT_GZIP_LEVELS = "0"
+
+# Load defaults
+DEFAULT_DURATION = 10
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RESPONSE_SIZE = 1024
+
+# Maximum allowed relative regression against the baseline
+DEFAULT_MAX_REGRESSION = 0.1
+
+# Seconds to wait for nginx and the stub backends to accept connections
+STARTUP_TIMEOUT = 10
+
+# Request path and gRPC method served by the stub backends
+REQUEST_PATH = "/benchmark"
+GRPC_SERVICE = "esp.benchmark.Stub"
+GRPC_METHOD = "Echo"
+
+# Listener flag of start_esp for every protocol
+PORT_FLAGS = {
+    "http": "--http_port",
+    "http2": "--http2_port",
+    "ssl": "--ssl_port",
+}
+
+Variant = collections.namedtuple('Variant',
+        ['proto', 'keepalive', 'workers', 'gzip'])
+Result = collections.namedtuple('Result',
+        ['requests', 'errors', 'rps', 'p50', 'p99', 'p999',
+         'response_bytes', 'cpu_us'])
+
+
+def variant_name(variant):
+    name = "{}-keepalive{}-workers{}".format(
+        variant.proto, variant.keepalive, variant.workers)
+    if variant.gzip:
+        name += "-gzip{}".format(variant.gzip)
+    return name
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+def make_body(size):
+    """Builds a JSON response body of roughly the given size."""
+    items = []
+    length = 0
+    for i in itertools.count():
+        item = json.dumps({"id": i, "name": "item-%d" % i, "value": i * 7})
+        if length + len(item) > size and items:
+            break
+        items.append(item)
+        length += len(item) + 1
+    return '{"items": [' + ",".join(items) + ']}'
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer the response and send it in one segment
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    body = ""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve_http_stub(port, body):
+    StubHandler.body = body
+    StubHTTPServer(('127.0.0.1', port), StubHandler).serve_forever()
+
+
+def serve_grpc_stub(port, body):
+    from concurrent import futures
+    handler = grpc.method_handlers_generic_handler(GRPC_SERVICE, {
+        GRPC_METHOD: grpc.unary_unary_rpc_method_handler(
+            lambda request, context: body),
+    })
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+    server.add_generic_rpc_handlers((handler,))
+    server.add_insecure_port('127.0.0.1:%d' % port)
+    server.start()
+    while True:
+        time.sleep(3600)
+
+
+def run_http_client(port, use_ssl, deadline, results):
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    conn = None
+    while time.time() < deadline:
+        if conn is None:
+            if use_ssl:
+                conn = httplib.HTTPSConnection('127.0.0.1', port, timeout=10,
+                        context=ssl._create_unverified_context())
+            else:
+                conn = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+        start = time.time()
+        try:
+            conn.request("GET", REQUEST_PATH,
+                         headers={"Accept-Encoding": "gzip"})
+            response = conn.getresponse()
+            # httplib does not decode, this is the body as sent by nginx
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            errors += 1
+            conn.close()
+            conn = None
+            continue
+        if response.status == 200:
+            latencies.append(time.time() - start)
+            response_bytes += len(body)
+        else:
+            errors += 1
+        if response.getheader("connection", "").lower() == "close":
+            conn.close()
+            conn = None
+    results.put((latencies, errors, response_bytes))
+
+
+def run_grpc_client(port, deadline, results):
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    channel = grpc.insecure_channel('127.0.0.1:%d' % port)
+    echo = channel.unary_unary("/{}/{}".format(GRPC_SERVICE, GRPC_METHOD))
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            response = echo(b"", timeout=10)
+        except grpc.RpcError:
+            errors += 1
+            continue
+        latencies.append(time.time() - start)
+        response_bytes += len(response)
+    results.put((latencies, errors, response_bytes))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def generate_load(variant, port, duration, concurrency):
+    """Drives closed-loop load from separate processes and merges results."""
+    results = multiprocessing.Queue()
+    deadline = time.time() + duration
+    clients = []
+    for _ in xrange(concurrency):
+        if variant.proto == "http2":
+            client = multiprocessing.Process(target=run_grpc_client,
+                    args=(port, deadline, results))
+        else:
+            client = multiprocessing.Process(target=run_http_client,
+                    args=(port, variant.proto == "ssl", deadline, results))
+        client.start()
+        clients.append(client)
+
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    for _ in clients:
+        client_latencies, client_errors, client_bytes = results.get()
+        latencies.extend(client_latencies)
+        errors += client_errors
+        response_bytes += client_bytes
+    for client in clients:
+        client.join()
+
+    latencies.sort()
+    return Result(
+            requests=len(latencies),
+            errors=errors,
+            rps=len(latencies) / float(duration),
+            p50=percentile(latencies, 0.5) * 1000,
+            p99=percentile(latencies, 0.99) * 1000,
+            p999=percentile(latencies, 0.999) * 1000,
+            response_bytes=response_bytes / max(len(latencies), 1),
+            cpu_us=0.0)
+
+
+def make_certificate(workdir):
+    crt = os.path.join(workdir, "nginx.crt")
+    key = os.path.join(workdir, "nginx.key")
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                               "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                               "-keyout", key, "-out", crt],
+                              stdout=devnull, stderr=devnull)
+    return crt, key
+
+
+def render_config(variant, port, backend, workdir, certificate):
+    """Renders the template through start_esp and localizes system paths."""
+    status_port = free_port()
+    esp_args = start_esp.make_argparser().parse_args([
+        PORT_FLAGS[variant.proto], str(port),
+        '--status_port', str(status_port),
+        '--backend', backend,
+        '--template', os.path.join(TEMPLATE_DIR, 'nginx-auto.conf.template'),
+        '--config_dir', workdir,
+        '--pid_file', os.path.join(workdir, 'nginx.pid'),
+        '--access_log', 'off',
+        '--worker_processes', str(variant.workers),
+        '--upstream_keepalive', str(variant.keepalive)] +
+        (['--gzip_level', str(variant.gzip)] if variant.gzip else []))
+    start_esp.handle_xff_trusted_proxies(esp_args)
+    start_esp.handle_dns(esp_args)
+    ingress = start_esp.make_ingress(esp_args)
+    nginx_conf = os.path.join(workdir, "nginx.conf")
+    start_esp.write_template([ingress], nginx_conf, esp_args,
+                             endpoints=False)
+
+    crt, key = certificate
+    rewrites = [
+        ("user nginx nginx;", ""),
+        ("include /etc/nginx/mime.types;", ""),
+        ("include /var/lib/nginx/extra/*.conf;", ""),
+        ("/etc/nginx/ssl/nginx.crt", crt),
+        ("/etc/nginx/ssl/nginx.key", key),
+    ]
+    with open(nginx_conf) as f:
+        conf = f.read()
+    for old, new in rewrites:
+        conf = conf.replace(old, new)
+    with open(nginx_conf, 'w') as f:
+        f.write(conf)
+    return nginx_conf
+
+
+def run_variant(args, variant, backends, certificate):
+    workdir = tempfile.mkdtemp(prefix="esp-load-")
+    try:
+        port = free_port()
+        nginx_conf = render_config(variant, port, backends[variant.proto],
+                                   workdir, certificate)
+        with open(os.path.join(workdir, "error.log"), 'w') as error_log:
+            nginx = subprocess.Popen([args.nginx, '-p', workdir,
+                                      '-c', nginx_conf], stderr=error_log)
+        result = None
+        try:
+            if not wait_for_port(port):
+                logging.error("nginx did not start for variant {}, see {}"
+                              .format(variant_name(variant), workdir))
+                return None
+            result = generate_load(variant, port, args.duration,
+                                   args.concurrency)
+        finally:
+            nginx.terminate()
+            # The usage includes the workers, which the master reaps
+            _, _, usage = os.wait4(nginx.pid, 0)
+        cpu = usage.ru_utime + usage.ru_stime
+        return result._replace(
+                cpu_us=cpu * 1e6 / max(result.requests, 1))
+    finally:
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def start_backends(protocols, body):
+    processes = []
+    backends = {}
+    if set(protocols) & set(["http", "ssl"]):
+        port = free_port()
+        processes.append(multiprocessing.Process(target=serve_http_stub,
+                                                 args=(port, body)))
+        backends["http"] = backends["ssl"] = "127.0.0.1:%d" % port
+    if "http2" in protocols:
+        port = free_port()
+        processes.append(multiprocessing.Process(target=serve_grpc_stub,
+                                                 args=(port, body)))
+        backends["http2"] = "grpc://127.0.0.1:%d" % port
+    for process in processes:
+        process.daemon = True
+        process.start()
+    for backend in backends.values():
+        if not wait_for_port(int(backend.rsplit(":", 1)[1])):
+            logging.error("Stub backend {} did not start".format(backend))
+            sys.exit(3)
+    return processes, backends
+
+
+def find_regressions(results, baseline, max_regression):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["rps"] < expected["rps"] * (1 - max_regression):
+            regressions.append("{}: {:.0f} rps, baseline {:.0f} rps".format(
+                name, result["rps"], expected["rps"]))
+        if result["p99"] > expected["p99"] * (1 + max_regression):
+            regressions.append("{}: p99 {:.2f} ms, baseline {:.2f} ms".format(
+                name, result["p99"], expected["p99"]))
+    return regressions
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description='''
+    Load test harness for the generated nginx.conf. Renders the nginx config
+    template without the Endpoints module for every combination of protocol,
+    upstream keepalive and worker count, runs it with a stock nginx in front of
+    local stub backends and reports RPS and p50/p99/p999 latency.''')
+
+    parser.add_argument('--nginx', default=DEFAULT_NGINX, help='''
+    Stock nginx binary. Default value: {nginx}'''.format(nginx=DEFAULT_NGINX))
+
+    parser.add_argument('--protocols', default=DEFAULT_PROTOCOLS, help='''
+    Comma separated list of listener protocols, [http|http2|ssl]. Default
+    value: {protocols}'''.format(protocols=DEFAULT_PROTOCOLS))
+
+    parser.add_argument('--keepalives', default=DEFAULT_KEEPALIVES, help='''
+    Comma separated list of upstream keepalive connection counts, 0 disables
+    upstream keepalive. Does not apply to http2 variants. Default value:
+    {keepalives}'''.format(
+        keepalives=DEFAULT_KEEPALIVES))
+
+    parser.add_argument('--workers', default=DEFAULT_WORKERS, help='''
+    Comma separated list of nginx worker process counts. Default value:
+    {workers}'''.format(workers=DEFAULT_WORKERS))
+
+    parser.add_argument('--gzip_levels', default=DEFAULT_GZIP_LEVELS, help='''
+    Comma separated list of gzip compression levels of the http and ssl
+    variants, 0 disables compression. Only responses of at least the
+    start_esp minimum length are compressed, so use a large enough
+    --response_size. Default value: {levels}'''.format(
+        levels=DEFAULT_GZIP_LEVELS))
+
+    parser.add_argument('--duration', default=DEFAULT_DURATION, type=int,
+    help='''Seconds of load per variant. Default value:
+    {duration}'''.format(duration=DEFAULT_DURATION))
+
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, type=int,
+    help='''Number of client processes, each with one persistent connection.
+    Default value: {concurrency}'''.format(concurrency=DEFAULT_CONCURRENCY))
+
+    parser.add_argument('--response_size', default=DEFAULT_RESPONSE_SIZE,
+    type=int, help='''Size of the stub backend response in bytes. Default
+    value: {size}'''.format(size=DEFAULT_RESPONSE_SIZE))
+
+    parser.add_argument('--output', default=None, help='''Write the results
+    as JSON to this file, e.g. to use them as a baseline later.''')
+
+    parser.add_argument('--baseline', default=None, help='''Compare the
+    results with a JSON file written by --output and exit with code 1 on
+    regressions.''')
+
+    parser.add_argument('--max_regression', default=DEFAULT_MAX_REGRESSION,
+    type=float, help='''Maximum allowed relative drop of RPS or growth of p99
+    latency against the baseline. Default value:
+    {regression}'''.format(regression=DEFAULT_MAX_REGRESSION))
+
+    parser.add_argument('--keep_workdir', action='store_true',
+    help='''Keep the rendered config and the nginx error log of every
+    variant.''')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = make_argparser()
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    protocols = split_list(args.protocols)
+    if "http2" in protocols and grpc is None:
+        logging.warning("Skipping http2 variants: grpcio is not installed")
+        protocols.remove("http2")
+
+    # gRPC responses are never compressed
+    gzip_levels = dict((proto, [0] if proto == "http2" else
+                        [int(level) for level in split_list(args.gzip_levels)])
+                       for proto in protocols)
+    # grpc_pass has no upstream block, upstream keepalive does not apply
+    keepalives = dict((proto, [0] if proto == "http2" else
+                       [int(keepalive)
+                        for keepalive in split_list(args.keepalives)])
+                      for proto in protocols)
+    variants = [Variant(proto, keepalive, int(workers), gzip)
+                for proto in protocols
+                for keepalive in keepalives[proto]
+                for workers in split_list(args.workers)
+                for gzip in gzip_levels[proto]]
+
+    certdir = tempfile.mkdtemp(prefix="esp-load-cert-")
+    try:
+        certificate = make_certificate(certdir)
+        processes, backends = start_backends(protocols,
+                                             make_body(args.response_size))
+
+        row = "{:<38} {:>10} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}"
+        print row.format("variant", "requests", "errors", "rps",
+                         "p50 ms", "p99 ms", "p999 ms", "bytes/resp",
+                         "cpu us/req")
+        results = {}
+        for variant in variants:
+            result = run_variant(args, variant, backends, certificate)
+            if result is None:
+                sys.exit(3)
+            results[variant_name(variant)] = result._asdict()
+            print row.format(variant_name(variant), result.requests,
+                             result.errors, "%.0f" % result.rps,
+                             "%.2f" % result.p50, "%.2f" % result.p99,
+                             "%.2f" % result.p999, result.response_bytes,
+                             "%.1f" % result.cpu_us)
+            sys.stdout.flush()
+
+        for process in processes:
+            process.terminate()
+    finally:
+        shutil.rmtree(certdir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=2,
+                      separators=(',', ': '))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f),
+                                           args.max_regression)
+        for regression in regressions:
+            logging.error("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Content-addressed store of service configs.
+# Every config is saved once as <sha256>.json in the config directory, with
+# a summary in <sha256>.summary.json. manifest.json maps config IDs to the
+# hash of their content and the time they were last used, and the hashes of
+# fetched responses to the configs they validated into.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+# Manifest of the store, relative to the config directory
+MANIFEST_FILE = "manifest.json"
+
+# Number of configs kept besides the ones in use
+DEFAULT_HISTORY = 5
+
+_OBJECT_RE = re.compile(r"^(?P<digest>[0-9a-f]{64})(\.summary)?\.json$")
+
+# Configs of former start_esp versions, named by uuid5 of the config ID
+_LEGACY_RE = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+def dumps(config):
+    """Serialize a config the way it is saved, so equal configs hash equally."""
+    return json.dumps(config, sort_keys=True, indent=2, separators=(',', ': '))
+
+def write_atomic(path, data):
+    """Write data to path through a rename, readers never see partial files."""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def summarize(config, size):
+    """Summary of a service config, size is the length of the saved file."""
+    methods = 0
+    for api in config.get("apis", []):
+        methods += len(api.get("methods", []))
+
+    http_rules = 0
+    for rule in config.get("http", {}).get("rules", []):
+        http_rules += 1 + len(rule.get("additionalBindings", []))
+
+    authentication = config.get("authentication", {})
+    return {
+        "name": config.get("name"),
+        "id": config.get("id"),
+        "methods": methods,
+        "http_rules": http_rules,
+        "auth": bool(authentication.get("providers")),
+        "size": size,
+    }
+
+def summary_path(path):
+    """Path of the summary of the config at path."""
+    root, ext = os.path.splitext(path)
+    return root + ".summary" + ext
+
+def write_summary(path, summary):
+    write_atomic(summary_path(path), dumps(summary))
+
+def read_summary(path):
+    try:
+        with open(summary_path(path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def format_summary(summary):
+    return ("{} methods, {} HTTP rules, authentication {}, {} bytes".format(
+        summary["methods"], summary["http_rules"],
+        "on" if summary["auth"] else "off", summary["size"]))
+
+class ConfigStore(object):
+    """Service configs of a config directory, addressed by content hash."""
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        self.manifest_path = os.path.join(config_dir, MANIFEST_FILE)
+        self.configs, self.validated = self._read_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            return (dict(manifest["configs"]),
+                    dict(manifest.get("validated", {})))
+        except IOError:
+            return {}, {}
+        except (ValueError, KeyError, TypeError):
+            # The manifest is rebuilt from the configs fetched next
+            logging.warning("Ignoring invalid config manifest " +
+                            self.manifest_path)
+            return {}, {}
+
+    def object_path(self, digest):
+        return os.path.join(self.config_dir, digest + ".json")
+
+    def _use(self, config_id, digest):
+        self.configs[config_id] = {
+            "sha256": digest,
+            "last_used": time.time(),
+        }
+
+    def get_validated(self, config_id, service, response):
+        """Path of the config that response was validated into, or None.
+
+        response is the fetched config as returned by the service, for which
+        config_id of service was requested.
+        """
+        entry = self.validated.get(hashlib.sha256(response).hexdigest())
+        if (entry is None or entry.get("service") != service or
+                entry.get("id") != config_id):
+            return None
+        path = self.object_path(entry["sha256"])
+        if not os.path.exists(path) or read_summary(path) is None:
+            return None
+        self._use(config_id, entry["sha256"])
+        return path
+
+    def put(self, config_id, config, service=None, response=None):
+        """Save a config unless its content is stored, returns its path.
+
+        If response is set, config is the validated form of it and later
+        fetches of the same response are looked up with get_validated.
+        """
+        data = dumps(config)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        if read_summary(path) is None:
+            write_summary(path, summarize(config, len(data)))
+        self._use(config_id, digest)
+        if response is not None:
+            self.validated[hashlib.sha256(response).hexdigest()] = {
+                "service": service,
+                "id": config_id,
+                "sha256": digest,
+            }
+        return path
+
+    def gc(self, config_ids, history=DEFAULT_HISTORY):
+        """Delete configs other than config_ids and the last history ones.
+
+        Configs written by former start_esp versions are deleted as well.
+        """
+        keep = set(config_ids)
+        recent = sorted((config_id for config_id in self.configs
+                         if config_id not in keep),
+                        key=lambda config_id: self.configs[config_id].get(
+                            "last_used", 0),
+                        reverse=True)
+        keep.update(recent[:history])
+        self.configs = dict((config_id, entry)
+                            for config_id, entry in self.configs.iteritems()
+                            if config_id in keep)
+        live = set(entry["sha256"] for entry in self.configs.itervalues())
+        self.validated = dict((response, entry)
+                              for response, entry in self.validated.iteritems()
+                              if entry["sha256"] in live)
+
+        for name in os.listdir(self.config_dir):
+            match = _OBJECT_RE.match(name)
+            if match and match.group("digest") in live:
+                continue
+            if match or _LEGACY_RE.match(name):
+                logging.info("Deleting unused service config " + name)
+                os.remove(os.path.join(self.config_dir, name))
+
+    def save(self):
+        write_atomic(self.manifest_path,
+                     dumps({"configs": self.configs,
+                            "validated": self.validated}))
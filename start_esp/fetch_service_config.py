@@ -15,9 +15,13 @@
 # limitations under the License.
 #
 
+import argparse
 import certifi
 import json
 import logging
+import os
+import sys
+import time
 import urllib3
 from oauth2client.service_account import ServiceAccountCredentials
 
@@ -34,6 +38,30 @@ _METADATA_SERVICE_NAME = "endpoints-service-name"
 _METADATA_SERVICE_CONFIG_ID = "endpoints-service-config-id"
 _METADATA_ROLLOUT_STRATEGY = "endpoints-rollout-strategy"
 
+# Service management service
+_SERVICE_MGMT_URL_TEMPLATE = "{}/v1/services/{}/config?configId={}"
+
+# Defaults of the command line tool
+_METADATA_ADDRESS = "http://metadata.google.internal"
+_MANAGEMENT_ADDRESS = "https://servicemanagement.googleapis.com"
+_OUTPUT_DIR = "/etc/nginx/endpoints"
+_OUTPUT_FILE = "service.json"
+
+# Retries of the command line tool, matching the former curl flags
+_MAX_RETRIES = 5
+_MAX_RETRY_DELAY = 60
+
+def make_http_client(retries=None):
+    """Create a pooled HTTP client, retrying requests if retries is set."""
+    if retries is None:
+        return urllib3.PoolManager(maxsize=16, ca_certs=certifi.where())
+    return urllib3.PoolManager(maxsize=16, ca_certs=certifi.where(),
+                               retries=retries)
+
+# HTTP client shared by all requests, so that connections to the metadata and
+# service management services are reused. PoolManager is thread-safe.
+_HTTP_CLIENT = make_http_client()
+
 class FetchError(Exception):
     """Error class for fetching and validation errors."""
     def __init__(self, code, message):
@@ -47,7 +75,7 @@ def fetch_service_config_rollout_strategy(metadata):
     url = metadata + _METADATA_PATH + "/attributes/" + \
         _METADATA_ROLLOUT_STRATEGY
     headers = {"Metadata-Flavor": "Google"}
-    client = urllib3.PoolManager(ca_certs=certifi.where())
+    client = _HTTP_CLIENT
     try:
         response = client.request("GET", url, headers=headers)
     except:
@@ -68,7 +96,7 @@ def fetch_service_name(metadata):
     """Fetch service name from metadata URL."""
     url = metadata + _METADATA_PATH + "/attributes/" + _METADATA_SERVICE_NAME
     headers = {"Metadata-Flavor": "Google"}
-    client = urllib3.PoolManager(ca_certs=certifi.where())
+    client = _HTTP_CLIENT
     try:
         response = client.request("GET", url, headers=headers)
     except:
@@ -89,7 +117,7 @@ def fetch_service_config_id(metadata):
     """Fetch service config ID from metadata URL."""
     url = metadata + _METADATA_PATH + "/attributes/" + _METADATA_SERVICE_CONFIG_ID
     headers = {"Metadata-Flavor": "Google"}
-    client = urllib3.PoolManager(ca_certs=certifi.where())
+    client = _HTTP_CLIENT
     try:
         response = client.request("GET", url, headers=headers)
         if response.status != 200:
@@ -128,7 +156,7 @@ def fetch_access_token(metadata):
     """Fetch access token from metadata URL."""
     access_token_url = metadata + _METADATA_PATH + "/service-accounts/default/token"
     headers = {"Metadata-Flavor": "Google"}
-    client = urllib3.PoolManager(ca_certs=certifi.where())
+    client = _HTTP_CLIENT
     try:
         response = client.request("GET", access_token_url, headers=headers)
     except:
@@ -150,7 +178,7 @@ def fetch_latest_rollout(management_service, service_name, access_token):
     else:
         headers = {"Authorization": "Bearer {}".format(access_token)}
 
-    client = urllib3.PoolManager(ca_certs=certifi.where())
+    client = _HTTP_CLIENT
 
     service_mgmt_url = SERVICE_MGMT_ROLLOUTS_URL_TEMPLATE.format(management_service,
                                                                  service_name)
@@ -180,14 +208,14 @@ def fetch_latest_rollout(management_service, service_name, access_token):
 
     return rollouts["rollouts"][0]
 
-def fetch_service_json(service_mgmt_url, access_token):
-    """Fetch service config."""
+def fetch_service_data(service_mgmt_url, access_token):
+    """Fetch service config as it is returned by the service."""
     if access_token is None:
         headers = {}
     else:
         headers = {"Authorization": "Bearer {}".format(access_token)}
 
-    client = urllib3.PoolManager(ca_certs=certifi.where())
+    client = _HTTP_CLIENT
     try:
         response = client.request("GET", service_mgmt_url, headers=headers)
     except:
@@ -198,7 +226,12 @@ def fetch_service_json(service_mgmt_url, access_token):
         message_template = "Fetching service config failed (status code {}, reason {}, url {})"
         raise FetchError(1, message_template.format(status_code, response.reason, service_mgmt_url))
 
-    service_config = json.loads(response.data)
+    return response.data
+
+def fetch_service_json(service_mgmt_url, access_token):
+    """Fetch service config."""
+    service_config = json.loads(fetch_service_data(service_mgmt_url,
+                                                   access_token))
     return service_config
 
 
@@ -238,3 +271,142 @@ def validate_service_config(service_config, expected_service_name,
         logging.warning("Replacing sandbox control environment in the service config")
         service_config["control"]["environment"] = (
             "servicecontrol.googleapis.com")
+
+
+def validate_service_config_file(path, service_name, service_version):
+    """Check name and ID of a saved service config, returns an exit code."""
+    try:
+        with open(path) as f:
+            service_config = json.load(f)
+        retrieved_name = service_config["name"]
+        retrieved_version = service_config["id"]
+    except (IOError, ValueError, KeyError, TypeError):
+        logging.error("Failed to extract Endpoints service name and config ID "
+                      "from " + path)
+        return 2
+
+    if retrieved_name != service_name:
+        logging.error("Unexpected service name {} in {}. Expected {}".format(
+            retrieved_name, path, service_name))
+        return 3
+
+    if retrieved_version != service_version:
+        logging.error("Unexpected service config ID {} in {}. Expected {}"
+                      .format(retrieved_version, path, service_version))
+        return 3
+
+    logging.info("Success: ESP configuration for service {} and config ID {} "
+                 "is in {}".format(service_name, service_version, path))
+    return 0
+
+def fetch_service_json_with_retries(metadata, service_mgmt_url):
+    """Fetch service config, with a fresh access token for every attempt."""
+    deadline = time.time() + _MAX_RETRY_DELAY
+    delay = 1
+    for attempt in range(_MAX_RETRIES + 1):
+        try:
+            token = fetch_access_token(metadata)
+        except (ValueError, KeyError, TypeError):
+            raise FetchError(2, "Failed to extract access token from the "
+                             "metadata server response")
+        try:
+            return fetch_service_json(service_mgmt_url, token)
+        except ValueError:
+            raise FetchError(2, "Failed to extract service config from the "
+                             "Service Management API response")
+        except FetchError as err:
+            if attempt == _MAX_RETRIES or time.time() + delay > deadline:
+                raise FetchError(4, err.message)
+            logging.warning(err.message + ", retrying")
+            time.sleep(delay)
+            delay *= 2
+
+class _ArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        self.print_help(sys.stderr)
+        self.exit(1, '%s: error: %s\n' % (self.prog, message))
+
+def make_argparser():
+    parser = _ArgumentParser(add_help=False, description='''
+Fetches the Endpoints service configuration from Google Service Management
+API into {output}.
+
+Exit codes:
+    0 - success,
+    1 - failure to read data from the metadata server,
+    2 - failure to extract data from input,
+    3 - unexpected data extracted from input,
+    4 - failure to call Service Management API.'''.format(
+        output=os.path.join(_OUTPUT_DIR, _OUTPUT_FILE)),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('-h', action='store_true', help='''Shows this
+    message.''')
+
+    parser.add_argument('-s', dest='service', help='''The Endpoints service
+    name. If this flag is not provided, the metadata value "{key}" is read
+    instead.'''.format(key=_METADATA_SERVICE_NAME))
+
+    parser.add_argument('-v', dest='version', help='''The Endpoints service
+    config ID. If this flag is not provided, the metadata value "{key}" is
+    read instead.'''.format(key=_METADATA_SERVICE_CONFIG_ID))
+
+    return parser
+
+def main(argv):
+    """Command line tool replacing fetch_service_config.sh, returns exit code."""
+    global _HTTP_CLIENT
+    parser = make_argparser()
+    args = parser.parse_args(argv)
+    if args.h:
+        parser.print_help(sys.stderr)
+        return 1
+
+    _HTTP_CLIENT = make_http_client(urllib3.Retry(
+        total=_MAX_RETRIES, backoff_factor=1,
+        status_forcelist=[408, 429, 500, 502, 503, 504]))
+
+    try:
+        if not args.service:
+            args.service = fetch_service_name(_METADATA_ADDRESS)
+        if not args.version:
+            args.version = fetch_service_config_id(_METADATA_ADDRESS)
+            if not args.version:
+                raise FetchError(1, "Failed to read metadata with key {} from "
+                                 "the metadata server".format(
+                                     _METADATA_SERVICE_CONFIG_ID))
+
+        # If the output file already exists, keep it if it is the config
+        # we expect. Otherwise download the config and overwrite it.
+        output_file = os.path.join(_OUTPUT_DIR, _OUTPUT_FILE)
+        if os.path.isfile(output_file):
+            logging.info("Service configuration file {} already exists"
+                         .format(output_file))
+            if validate_service_config_file(output_file, args.service,
+                                            args.version) == 0:
+                return 0
+
+        if not os.path.isdir(_OUTPUT_DIR):
+            os.makedirs(_OUTPUT_DIR)
+
+        logging.info("Downloading Endpoints service configuration to " +
+                     output_file)
+        service_config = fetch_service_json_with_retries(
+            _METADATA_ADDRESS, _SERVICE_MGMT_URL_TEMPLATE.format(
+                _MANAGEMENT_ADDRESS, args.service, args.version))
+        with open(output_file, 'w') as f:
+            json.dump(service_config, f, sort_keys=True, indent=2,
+                      separators=(',', ': '))
+    except FetchError as err:
+        logging.error(err.message)
+        return err.code
+    except (IOError, OSError) as err:
+        logging.error("Cannot save service config: " + str(err))
+        return 4
+
+    return validate_service_config_file(output_file, args.service,
+                                        args.version)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -26,13 +26,23 @@
 
 import argparse
 import collections
+import config_store
+import copy
+import errno
 import fetch_service_config as fetch
+import fnmatch
+import httplib
 import json
 import logging
 import os
 import re
+import socket
+import ssl
+import status_exporter
 import sys
 import textwrap
+import threading
+import time
 import uuid
 
 from collections import Counter
@@ -64,9 +74,12 @@ MANAGEMENT_ADDRESS = "https://servicemanagement.googleapis.com"
 # Service management service
 SERVICE_MGMT_URL_TEMPLATE = ("{}/v1/services/{}/config?configId={}")
 
-# DNS resolver
+# DNS resolver, used if resolv.conf lists no nameserver
 DNS_RESOLVER = "8.8.8.8"
 
+# System resolver configuration
+RESOLV_CONF = "/etc/resolv.conf"
+
 # Default HTTP/1.x port
 DEFAULT_PORT = 8080
 
@@ -82,6 +95,62 @@ DEFAULT_ROLLOUT_STRATEGY = "fixed"
 # Default xff_trusted_proxy_list
 DEFAULT_XFF_TRUSTED_PROXY_LIST = "0.0.0.0/0, 0::/0"
 
+# Default number of nginx worker processes
+DEFAULT_WORKER_PROCESSES = "1"
+
+# Default number of idle keepalive connections per upstream and worker
+DEFAULT_UPSTREAM_KEEPALIVE = 128
+
+# Default seconds between scrapes of the status exporter
+DEFAULT_STATUS_EXPORTER_INTERVAL = 10
+
+# Default status code of requests rejected by rate limits
+DEFAULT_OVERLOAD_STATUS = 429
+
+# Default minimum length in bytes of compressed responses
+DEFAULT_GZIP_MIN_LENGTH = 1024
+
+# Default MIME types of compressed responses, text/html always is
+DEFAULT_GZIP_TYPES = ("application/json,application/javascript,"
+                      "application/xml,text/css,text/plain,text/xml")
+
+# Default requests through proxies whose responses are compressed
+DEFAULT_GZIP_PROXIED = "any"
+
+# gzip_proxied values accepted by nginx
+GZIP_PROXIED_VALUES = frozenset([
+        'off', 'expired', 'no-cache', 'no-store', 'private',
+        'no_last_modified', 'no_etag', 'auth', 'any'])
+
+# MIME types that are compressed already or streamed and never gzipped.
+# Entries ending with "/" match a whole media type.
+GZIP_SKIP_TYPES = (
+        'application/grpc', 'application/gzip', 'application/x-gzip',
+        'application/zip', 'application/octet-stream', 'image/jpeg',
+        'image/png', 'image/gif', 'image/webp', 'font/woff', 'font/woff2',
+        'audio/', 'video/')
+
+# Default location and size limits of the response cache
+DEFAULT_CACHE_PATH = "/var/cache/nginx/esp"
+DEFAULT_CACHE_MAX_SIZE = "1g"
+DEFAULT_CACHE_ZONE_SIZE = "10m"
+
+# Minimum seconds unused cache entries are kept, to serve them while stale
+CACHE_INACTIVE = 600
+
+# Marker file in the config directory, the status port reports healthy once
+# it exists if --backend_ready_timeout is set
+READY_FILE = "backends.ready"
+
+# Default request path of the backend warm-up requests
+DEFAULT_BACKEND_WARMUP_PATH = "/"
+
+# Default number of concurrent warm-up requests per backend
+DEFAULT_BACKEND_WARMUP_CONNECTIONS = 8
+
+# Seconds between attempts to connect to a backend that is not ready
+BACKEND_PROBE_INTERVAL = 0.5
+
 # Default PID file location (for nginx as a daemon)
 DEFAULT_PID_FILE = "/var/run/nginx.pid"
 
@@ -93,7 +162,14 @@ Port = collections.namedtuple('Port',
 Location = collections.namedtuple('Location',
         ['path', 'backends', 'proto'])
 Ingress = collections.namedtuple('Ingress',
-        ['ports', 'host', 'locations'])
+        ['ports', 'host', 'locations', 'server_config', 'cache_routes'])
+CacheRoute = collections.namedtuple('CacheRoute',
+        ['path', 'ttl'])
+
+# Keys of an entry in the --services_file list
+SERVICE_ENTRY_KEYS = frozenset([
+        'service', 'version', 'rollout_strategy', 'service_config_url',
+        'http_port', 'http2_port', 'ssl_port', 'host', 'backend'])
 
 def write_pid_file(args):
     try:
@@ -105,7 +181,9 @@ def write_pid_file(args):
         logging.error(err.strerror)
         sys.exit(3)
 
-def write_template(ingress, nginx_conf, args):
+# Renders a plain nginx config without Endpoints module directives if
+# endpoints is False, e.g. for benchmarking against a stock nginx binary.
+def write_template(ingresses, nginx_conf, args, endpoints=True):
     # Load template
     try:
         template = Template(filename=args.template)
@@ -113,28 +191,58 @@ def write_template(ingress, nginx_conf, args):
         logging.error("Failed to load NGINX config template. " + err.strerror)
         sys.exit(3)
 
-    conf = template.render(
-            ingress=ingress,
+    conf = render_template(template, ingresses, args, endpoints)
+
+    # Save nginx conf
+    try:
+        f = open(nginx_conf, 'w+')
+        f.write(conf)
+        f.close()
+    except IOError as err:
+        logging.error("Failed to save NGINX config." + err.strerror)
+        sys.exit(3)
+
+def render_template(template, ingresses, args, endpoints=True):
+    return template.render(
+            ingresses=ingresses,
             pid_file=args.pid_file,
             status=args.status_port,
             service_account=args.service_account_key,
             metadata=args.metadata,
             resolver=args.dns,
+            dns_servers=args.dns_servers,
+            backend_dns_ttl=args.backend_dns_ttl,
+            dynamic_backends=make_dynamic_backends(ingresses, args),
             access_log=args.access_log,
             healthz=args.healthz,
             xff_trusted_proxies=args.xff_trusted_proxies,
             tls_mutual_auth=args.tls_mutual_auth,
             underscores_in_headers=args.underscores_in_headers,
-            allow_invalid_headers=args.allow_invalid_headers)
-
-    # Save nginx conf
-    try:
-        f = open(nginx_conf, 'w+')
-        f.write(conf)
-        f.close()
-    except IOError as err:
-        logging.error("Failed to save NGINX config." + err.strerror)
-        sys.exit(3)
+            allow_invalid_headers=args.allow_invalid_headers,
+            worker_processes=args.worker_processes,
+            upstream_keepalive=args.upstream_keepalive,
+            rate_limit=args.rate_limit,
+            rate_limit_burst=args.rate_limit_burst,
+            global_rate_limit=args.global_rate_limit,
+            global_rate_limit_burst=args.global_rate_limit_burst,
+            backend_max_conns=args.backend_max_conns,
+            overload_status=args.overload_status,
+            gzip_level=args.gzip_level,
+            gzip_min_length=args.gzip_min_length,
+            gzip_types=make_gzip_types(args),
+            gzip_proxied=args.gzip_proxied,
+            gzip_static=args.gzip_static,
+            ready_file=ready_file(args),
+            warmup=make_warmup_locations(ingresses, args),
+            warmup_path=args.backend_warmup_path,
+            cache=any(ingress.cache_routes for ingress in ingresses),
+            cache_path=args.cache_path,
+            cache_max_size=args.cache_max_size,
+            cache_zone_size=args.cache_zone_size,
+            cache_inactive=max([CACHE_INACTIVE] + [
+                route.ttl for ingress in ingresses
+                for route in ingress.cache_routes]),
+            endpoints=endpoints)
 
 def write_server_config_templage(server_config, args):
     # Load template
@@ -144,11 +252,7 @@ def write_server_config_templage(server_config, args):
         logging.error("Failed to load server config template. " + err.strerror)
         sys.exit(3)
 
-    conf = template.render(
-             service_configs=args.service_configs,
-             management=args.management,
-             rollout_id=args.rollout_id,
-             rollout_strategy=args.rollout_strategy)
+    conf = render_server_config_template(template, args)
 
     # Save nginx conf
     try:
@@ -159,6 +263,13 @@ def write_server_config_templage(server_config, args):
         logging.error("Failed to save server config." + err.strerror)
         sys.exit(3)
 
+def render_server_config_template(template, args):
+    return template.render(
+             service_configs=args.service_configs,
+             management=args.management,
+             rollout_id=args.rollout_id,
+             rollout_strategy=args.rollout_strategy)
+
 
 def ensure(config_dir):
     if not os.path.exists(config_dir):
@@ -175,6 +286,174 @@ def assert_file_exists(fl):
         sys.exit(3)
 
 
+def start_status_exporter(args):
+    parent_pid = os.getpid()
+    try:
+        pid = os.fork()
+    except OSError as err:
+        logging.error("Failed to start the status exporter")
+        logging.error(err.strerror)
+        sys.exit(3)
+
+    if pid == 0:
+        # The exporter runs next to nginx, which replaces the parent process,
+        # and exits once nginx is gone.
+        status_exporter.run(args.status_port, args.status_exporter_port,
+                            args.status_exporter_interval,
+                            parent_pid=parent_pid)
+        os._exit(0)
+
+def ready_file(args):
+    if args.backend_ready_timeout is None:
+        return None
+    return os.path.join(args.config_dir, READY_FILE)
+
+def make_warmup_locations(ingresses, args):
+    """Returns the (ingress, location) indexes of the upstreams to warm up.
+
+    Only upstreams with a keepalive pool are warmed up, gRPC backends and
+    backends resolved at request time have none.
+    """
+    if args.backend_ready_timeout is None or not args.upstream_keepalive:
+        return []
+    dynamic_backends = make_dynamic_backends(ingresses, args)
+    return [(j, i)
+            for j, ingress in enumerate(ingresses)
+            for i, location in enumerate(ingress.locations)
+            if location.proto in ('http', 'https') and
+            (j, i) not in dynamic_backends]
+
+def probe_backend(backend, proto, deadline):
+    """Connects to a backend until it accepts connections or the deadline.
+
+    HTTPS backends must complete a TLS handshake as well.
+    """
+    while True:
+        timeout = max(deadline - time.time(), 0.1)
+        try:
+            # A backend that cannot be parsed is not ready either
+            if backend.startswith('unix:'):
+                family, address = socket.AF_UNIX, backend[len('unix:'):]
+            else:
+                host, port = split_host_port(backend)
+                family, address = None, (host, int(port or 80))
+            if family is None:
+                sock = socket.create_connection(address, timeout)
+            else:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                sock.connect(address)
+            try:
+                if proto == 'https':
+                    context = ssl.create_default_context()
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                    context.wrap_socket(sock, server_hostname=address[0])
+            finally:
+                sock.close()
+            return True
+        except (socket.error, ssl.SSLError, ValueError) as err:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warning("Backend {} is not ready: {}".format(
+                    backend, err))
+                return False
+            time.sleep(min(BACKEND_PROBE_INTERVAL, remaining))
+
+def wait_for_backends(ingresses, timeout):
+    """Probes all backends in parallel, returns whether all are ready."""
+    deadline = time.time() + timeout
+    backends = set((backend, location.proto)
+                   for ingress in ingresses
+                   for location in ingress.locations
+                   for backend in location.backends)
+    ready = {}
+    def probe(backend, proto):
+        ready[(backend, proto)] = probe_backend(backend, proto, deadline)
+
+    logging.info("Waiting for {} backend(s) to accept connections".format(
+        len(backends)))
+    threads = [threading.Thread(target=probe, args=backend)
+               for backend in sorted(backends)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A probe thread that died never reported its backend ready
+    return all(ready.get(backend) for backend in backends)
+
+def warm_up_backends(args, warmup, parent_pid):
+    """Sends warm-up requests through nginx, then creates the ready file.
+
+    Every warm-up location on the status port proxies to one upstream, so
+    that the nginx workers open keepalive connections and TLS sessions to
+    the backends before the status port reports healthy.
+    """
+    deadline = time.time() + args.backend_ready_timeout
+    # nginx replaces the parent process and listens once it is configured
+    while os.getppid() == parent_pid and time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', args.status_port),
+                                     1).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    if os.getppid() != parent_pid:
+        return
+
+    def warm_up(path):
+        conn = httplib.HTTPConnection('127.0.0.1', args.status_port,
+                timeout=max(deadline - time.time(), 1))
+        try:
+            conn.request("GET", path)
+            conn.getresponse().read()
+        except (httplib.HTTPException, socket.error) as err:
+            logging.warning("Backend warm-up request {} failed: {}".format(
+                path, err))
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=warm_up,
+                                args=("/esp_warmup/{}/{}".format(j, i),))
+               for j, i in warmup
+               for _ in range(args.backend_warmup_connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    try:
+        open(ready_file(args), 'w').close()
+    except IOError as err:
+        logging.error("Cannot create the ready file " + ready_file(args))
+        logging.error(err.strerror)
+        return
+    logging.info("Backends are warmed up, reporting ready on the status port")
+
+def start_backend_warmup(args, ingresses):
+    # A ready file of the previous run would report readiness too early
+    try:
+        os.remove(ready_file(args))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            logging.error("Cannot remove the ready file " + ready_file(args))
+            logging.error(err.strerror)
+            sys.exit(3)
+
+    parent_pid = os.getpid()
+    try:
+        pid = os.fork()
+    except OSError as err:
+        logging.error("Failed to start the backend warm-up")
+        logging.error(err.strerror)
+        sys.exit(3)
+
+    if pid == 0:
+        # Like the status exporter, the warm-up runs next to nginx
+        warm_up_backends(args, make_warmup_locations(ingresses, args),
+                         parent_pid)
+        os._exit(0)
+
 def start_nginx(nginx, nginx_conf):
     try:
         # Control is relinquished to nginx process after this line
@@ -184,27 +463,89 @@ def start_nginx(nginx, nginx_conf):
         logging.error(err.strerror)
         sys.exit(3)
 
-def fetch_and_save_service_config_url(args, token, service_mgmt_url, filename):
+def validate_service_config(args, response, version):
+    """Parses and validates a fetched config, exits if it is invalid.
+
+    Without a version, as for --service_config_url, only the parts of the
+    config that do not depend on the requested name and ID are checked.
+    """
+    try:
+        config = json.loads(response)
+    except ValueError:
+        logging.error("Invalid service config JSON")
+        sys.exit(2)
+    if not isinstance(config, dict):
+        logging.error("Invalid service config JSON")
+        sys.exit(2)
+
+    try:
+        # Replaces the sandbox control environment in place
+        fetch.validate_service_config(config,
+                                      args.service or config.get("name"),
+                                      version or config.get("id"))
+    except fetch.FetchError as err:
+        logging.error(err.message)
+        sys.exit(err.code)
+    return config
+
+def fetch_and_save_service_config_url(args, token, service_mgmt_url, filename,
+                                      version=None):
     try:
         # download service config
-        config = fetch.fetch_service_json(service_mgmt_url, token)
+        response = fetch.fetch_service_data(service_mgmt_url, token)
+        config = validate_service_config(args, response, version)
 
-        # Save service json for ESP
+        # Save service json and its summary for ESP
         service_config = args.config_dir + "/" + filename
 
         try:
+            data = config_store.dumps(config)
             f = open(service_config, 'w+')
-            json.dump(config, f, sort_keys=True, indent=2,
-                      separators=(',', ': '))
+            f.write(data)
             f.close()
-        except IOError as err:
+            summary = config_store.summarize(config, len(data))
+            config_store.write_summary(service_config, summary)
+        except (IOError, OSError) as err:
             logging.error("Cannot save service config." + err.strerror)
             sys.exit(3)
+        logging.info("Service config {}: {}".format(
+            summary["id"], config_store.format_summary(summary)))
+
+    except fetch.FetchError as err:
+        logging.error(err.message)
+        sys.exit(err.code)
+
+def fetch_and_store_service_config(args, token, store, version):
+    """Fetches a config into the store, returns the path of the config.
 
+    Responses that were validated before are not parsed again.
+    """
+    service_mgmt_url = SERVICE_MGMT_URL_TEMPLATE.format(args.management,
+                                                        args.service,
+                                                        version)
+    logging.info("Fetching the service configuration "\
+                 "from the service management service")
+    try:
+        response = fetch.fetch_service_data(service_mgmt_url, token)
     except fetch.FetchError as err:
         logging.error(err.message)
         sys.exit(err.code)
 
+    try:
+        path = store.get_validated(version, args.service, response)
+        if path is None:
+            config = validate_service_config(args, response, version)
+            path = store.put(version, config, args.service, response)
+    except (IOError, OSError) as err:
+        logging.error("Cannot save service config." + err.strerror)
+        sys.exit(3)
+
+    summary = config_store.read_summary(path)
+    if summary is not None:
+        logging.info("Service config {}: {}".format(
+            version, config_store.format_summary(summary)))
+    return path
+
 def fetch_and_save_service_config(args, token, version, filename):
     try:
         # build request url
@@ -214,7 +555,8 @@ def fetch_and_save_service_config(args, token, version, filename):
         # Validate service config if we have service name and version
         logging.info("Fetching the service configuration "\
                      "from the service management service")
-        fetch_and_save_service_config_url(args, token, service_mgmt_url, filename)
+        fetch_and_save_service_config_url(args, token, service_mgmt_url,
+                                          filename, version)
 
     except fetch.FetchError as err:
         logging.error(err.message)
@@ -232,19 +574,237 @@ def handle_xff_trusted_proxies(args):
             proxy = proxy.strip()
             if proxy:
                 args.xff_trusted_proxies.append(proxy)
+    # real_ip takes the client address from X-Forwarded-For of any peer in
+    # the list, so clients choose the key of the per-client rate limit
+    if args.rate_limit and any(proxy in ('0.0.0.0/0', '0::/0', '::/0')
+                               for proxy in args.xff_trusted_proxies):
+        logging.warning("--rate_limit is keyed on the client address from "
+                        "X-Forwarded-For, which every client can set while "
+                        "all addresses are trusted proxies. Set "
+                        "--xff_trusted_proxy_list to the addresses of the "
+                        "load balancers in front of ESP.")
+
+def read_resolv_conf(path):
+    """Returns the nameservers and search domains of resolv.conf."""
+    nameservers = []
+    search = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = re.split(r'[#;]', line, 1)[0].split()
+                if len(fields) < 2:
+                    continue
+                if fields[0] == 'nameserver':
+                    nameservers.append(fields[1])
+                elif fields[0] in ('search', 'domain'):
+                    search = fields[1:]
+    except IOError as err:
+        logging.info("Cannot read " + path + ": " + err.strerror)
+    return nameservers, search
 
-def fetch_service_config(args):
-    args.service_configs = {};
-    args.rollout_id = ""
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+# nginx expects IPv6 resolver addresses in brackets, addresses with a port
+# or in brackets already are kept
+def format_dns_server(address):
+    try:
+        socket.inet_pton(socket.AF_INET6, address)
+    except (socket.error, ValueError):
+        return address
+    return '[' + address + ']'
+
+# resolve DNS servers and search domains
+def handle_dns(args):
+    nameservers, args.dns_search = read_resolv_conf(args.resolv_conf)
+    # nginx rejects scoped link-local addresses such as fe80::1%eth0
+    nameservers = [ns for ns in nameservers if '%' not in ns]
+    if args.dns is not None:
+        args.dns_servers = [format_dns_server(args.dns)]
+    elif nameservers:
+        args.dns_servers = [format_dns_server(ns) for ns in nameservers]
+    else:
+        args.dns_servers = [DNS_RESOLVER]
+    args.dns = args.dns_servers[0]
+
+def split_host_port(backend):
+    if backend.startswith('['):
+        host, _, rest = backend[1:].partition(']')
+        return host, rest[1:] if rest.startswith(':') else None
+    host, separator, port = backend.partition(':')
+    return host, port if separator else None
+
+# parse a --gzip_proxied value
+def gzip_proxied(value):
+    values = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = set(values) - GZIP_PROXIED_VALUES
+    if not values or unknown:
+        raise argparse.ArgumentTypeError(
+            "expected a comma separated list of " +
+            ", ".join(sorted(GZIP_PROXIED_VALUES)) + ", got " + value)
+    return values
+
+def is_gzip_skipped(mime_type):
+    for skipped in GZIP_SKIP_TYPES:
+        if skipped.endswith('/'):
+            if mime_type.startswith(skipped):
+                return True
+        elif mime_type == skipped or mime_type.startswith(skipped + '+') or \
+                mime_type.startswith(skipped + '-'):
+            return True
+    return False
+
+def make_gzip_types(args):
+    """Returns the --gzip_types that are worth compressing."""
+    gzip_types = []
+    if not args.gzip_level:
+        return gzip_types
+    for mime_type in args.gzip_types.split(','):
+        mime_type = mime_type.strip().lower()
+        # nginx warns about duplicates of the implicit text/html
+        if not mime_type or mime_type == 'text/html' or \
+                mime_type in gzip_types:
+            continue
+        if is_gzip_skipped(mime_type):
+            logging.warning("Not compressing MIME type " + mime_type +
+                            ", it is compressed already or streamed")
+            continue
+        gzip_types.append(mime_type)
+    return gzip_types
+
+def make_dynamic_backends(ingresses, args):
+    """Maps (ingress, location) indexes to backends resolved at request time.
+
+    With --backend_dns_ttl, single hostname HTTP(S) backends are proxied to
+    through a variable, so nginx resolves them with the DNS servers and
+    caches them for the TTL. nginx does not apply search domains and never
+    falls back to the name as given, so only single label names such as
+    Kubernetes service names are qualified with the first search domain.
+    Names with a dot are resolved as they are.
+    """
+    dynamic_backends = {}
+    if not args.backend_dns_ttl:
+        return dynamic_backends
+    for j, ingress in enumerate(ingresses):
+        for i, location in enumerate(ingress.locations):
+            if location.proto not in ('http', 'https') or \
+                    len(location.backends) != 1:
+                continue
+            host, port = split_host_port(location.backends[0])
+            if host == 'localhost' or host.startswith('unix') or \
+                    is_ip_address(host):
+                continue
+            if host.endswith('.'):
+                host = host[:-1]
+            elif args.dns_search and '.' not in host:
+                host = host + '.' + args.dns_search[0]
+            if port:
+                host = host + ':' + port
+            dynamic_backends[(j, i)] = host
+    return dynamic_backends
+
+# parse a --cache_route value
+def cache_route(value):
+    key, separator, ttl = value.rpartition('=')
+    if not separator or not key or not ttl.isdigit() or int(ttl) == 0:
+        raise argparse.ArgumentTypeError(
+            "expected PREFIX=SECONDS or SELECTOR=SECONDS, got " + value)
+    return key, int(ttl)
+
+def _path_segments_regex(segments):
+    regex = []
+    for segment in segments.split('/'):
+        if segment == '**':
+            regex.append('.*')
+        elif segment == '*':
+            regex.append('[^/]+')
+        else:
+            regex.append(re.escape(segment))
+    return '/'.join(regex)
+
+def http_rule_regex(template):
+    """Converts an HTTP rule path template to an nginx location regex."""
+    verb = ""
+    colon = template.rfind(':')
+    if colon > max(template.rfind('/'), template.rfind('}')):
+        template, verb = template[:colon], template[colon:]
+    regex = []
+    for part in re.split(r'(\{[^}]*\})', template):
+        if part.startswith('{'):
+            _, _, segments = part[1:-1].partition('=')
+            regex.append(_path_segments_regex(segments or '*'))
+        else:
+            regex.append(_path_segments_regex(part))
+    return '^' + ''.join(regex) + re.escape(verb) + '$'
 
+def read_get_rules(service_configs):
+    """Returns (selector, path template) of the GET HTTP rules of configs."""
+    rules = []
+    for path in service_configs:
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except (IOError, ValueError):
+            logging.error("Cannot read HTTP rules from service config " + path)
+            sys.exit(3)
+        for rule in config.get("http", {}).get("rules", []):
+            for binding in [rule] + rule.get("additionalBindings", []):
+                if binding.get("get"):
+                    rules.append((rule.get("selector", ""), binding["get"]))
+    return rules
+
+def make_cache_routes(args):
+    """Makes the cached locations of --cache_route.
+
+    A route for a path prefix becomes a prefix location. A route for a
+    selector, which may contain wildcards, becomes a regex location for
+    every GET HTTP rule of the service configs that it matches.
+    """
+    routes = []
+    rules = None
+    for key, ttl in args.cache_route or []:
+        if key.startswith('/'):
+            paths = [key]
+        else:
+            if rules is None:
+                rules = read_get_rules(args.service_configs)
+            paths = ['~ ' + http_rule_regex(template)
+                     for selector, template in rules
+                     if fnmatch.fnmatchcase(selector, key)]
+            if not paths:
+                logging.warning("No GET HTTP rule matches the cache route "
+                                "selector " + key)
+        for path in paths:
+            if path not in [route.path for route in routes]:
+                routes.append(CacheRoute(path, ttl))
+    return routes
+
+def fetch_access_token(args):
     try:
-        # Get the access token
         if args.service_account_key is None:
             logging.info("Fetching an access token from the metadata service")
-            token = fetch.fetch_access_token(args.metadata)
+            return fetch.fetch_access_token(args.metadata)
         else:
-            token = fetch.make_access_token(args.service_account_key)
+            return fetch.make_access_token(args.service_account_key)
+    except fetch.FetchError as err:
+        logging.error(err.message)
+        sys.exit(err.code)
+
+def fetch_service_config(args, token=None):
+    args.service_configs = {};
+    args.rollout_id = ""
+
+    # Get the access token
+    if token is None:
+        token = fetch_access_token(args)
 
+    try:
         if args.service_config_url is not None:
             # Set the file name to "service.json", if either service
             # config url or version is specified for backward compatibility
@@ -289,10 +849,23 @@ def fetch_service_config(args):
                 rollout = fetch.fetch_latest_rollout(args.management,
                                                      args.service, token)
                 args.rollout_id = rollout["rolloutId"]
-                for version, percentage in rollout["trafficPercentStrategy"]["percentages"].iteritems():
-                    filename = generate_service_config_filename(version)
-                    fetch_and_save_service_config(args, token, version, filename)
-                    args.service_configs[args.config_dir + "/" + filename] = percentage;
+                store = config_store.ConfigStore(args.config_dir)
+                percentages = rollout["trafficPercentStrategy"]["percentages"]
+                for version, percentage in percentages.iteritems():
+                    path = fetch_and_store_service_config(args, token, store,
+                                                          version)
+                    # Configs with equal content share a file
+                    args.service_configs[path] = (
+                        args.service_configs.get(path, 0) + percentage)
+
+                # Drop configs that are neither in the rollout nor recent
+                try:
+                    store.gc(percentages.keys(), args.config_history)
+                    store.save()
+                except (IOError, OSError) as err:
+                    logging.error("Cannot update the service config store." +
+                                  err.strerror)
+                    sys.exit(3)
             else:
                 # Set the file name to "service.json", if either service
                 # config url or version is specified for backward compatibility
@@ -317,7 +890,8 @@ def make_ingress(args):
     # Check for port collisions
     collisions = Counter([
             args.http_port, args.http2_port,
-            args.ssl_port, args.status_port])
+            args.ssl_port, args.status_port,
+            args.status_exporter_port])
     collisions.pop(None, 0)
     if len(collisions) > 0:
         shared_port, count = collisions.most_common(1)[0]
@@ -356,10 +930,129 @@ def make_ingress(args):
     ingress = Ingress(
             ports=ports,
             host='""',
-            locations=locations)
+            locations=locations,
+            server_config=SERVER_CONF,
+            cache_routes=make_cache_routes(args) if proto != "grpc" else [])
 
     return ingress
 
+def load_services(args):
+    """Loads --services_file into one argument namespace per service."""
+    try:
+        with open(args.services_file) as f:
+            entries = json.load(f)
+    except IOError as err:
+        logging.error("Cannot read services file " + args.services_file)
+        logging.error(err.strerror)
+        sys.exit(3)
+    except ValueError as err:
+        logging.error("Invalid services file: " + str(err))
+        sys.exit(2)
+
+    if not isinstance(entries, list) or len(entries) == 0:
+        logging.error("Services file must contain a non-empty list")
+        sys.exit(2)
+
+    services = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('service'):
+            logging.error("Service name is not specified in services file "
+                          "entry " + json.dumps(entry))
+            sys.exit(2)
+        unknown = set(entry) - SERVICE_ENTRY_KEYS
+        if unknown:
+            logging.error("Unknown keys in services file entry for {}: {}"
+                          .format(entry['service'], ", ".join(sorted(unknown))))
+            sys.exit(2)
+
+        # Every service inherits the flags and gets its own config directory
+        service = copy.copy(args)
+        service.version = None
+        service.service_config_url = None
+        service.service_json_path = None
+        service.http_port = None
+        service.http2_port = None
+        service.ssl_port = None
+        service.host = '""'
+        service.check_metadata = False
+        for key, value in entry.items():
+            if key.endswith('_port'):
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    logging.error("Invalid {} in services file entry for {}"
+                                  .format(key, entry['service']))
+                    sys.exit(2)
+            setattr(service, key, value)
+        service.config_dir = os.path.join(args.config_dir, service.service)
+        service.server_config = os.path.join(service.config_dir,
+                                             "server_config.pb.txt")
+        services.append(service)
+
+    names = Counter(service.service for service in services)
+    shared_name, count = names.most_common(1)[0]
+    if count > 1:
+        logging.error("Service " + shared_name + " is listed more than once.")
+        sys.exit(2)
+
+    return services
+
+def bootstrap_services(args, services):
+    """Fetches the configs of all services concurrently with one token."""
+    token = fetch_access_token(args)
+
+    # Services that bootstrapped, a thread that dies never reports success
+    exit_codes = {}
+    bootstrapped = set()
+    def bootstrap(service):
+        try:
+            ensure(service.config_dir)
+            fetch_service_config(service, token)
+            write_server_config_templage(service.server_config, service)
+            bootstrapped.add(service.service)
+        except SystemExit as err:
+            exit_codes[service.service] = err.code
+        except Exception as err:
+            logging.error("Unexpected error bootstrapping service " +
+                          service.service + ": " + repr(err))
+            exit_codes[service.service] = 3
+
+    threads = [threading.Thread(target=bootstrap, args=(service,))
+               for service in services]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for service in services:
+        if service.service not in bootstrapped:
+            logging.error("Failed to bootstrap service " + service.service)
+            sys.exit(exit_codes.get(service.service) or 3)
+
+def make_service_ingresses(args, services):
+    """Makes one ingress per service, checking ports shared by services."""
+    ingresses = []
+    # port -> (protocol, host -> service)
+    listeners = {}
+    for service in services:
+        ingress = make_ingress(service)._replace(
+                host=service.host,
+                server_config=service.server_config)
+        for port in ingress.ports:
+            proto, hosts = listeners.setdefault(port.port, (port.proto, {}))
+            if proto != port.proto:
+                logging.error("Port " + str(port.port) + " is used with "
+                              "different protocols.")
+                sys.exit(2)
+            if ingress.host in hosts:
+                logging.error("Services " + hosts[ingress.host] + " and " +
+                              service.service + " share port " +
+                              str(port.port) + " and host " + ingress.host)
+                sys.exit(2)
+            hosts[ingress.host] = service.service
+        ingresses.append(ingress)
+    return ingresses
+
 class ArgumentParser(argparse.ArgumentParser):
     def error(self, message):
         self.print_help(sys.stderr)
@@ -431,6 +1124,16 @@ config file.'''.format(
     available at /endpoints_status location over HTTP/1.x. Default value:
     {port}.'''.format(port=DEFAULT_STATUS_PORT))
 
+    parser.add_argument('--status_exporter_port', default=None, type=int,
+    help=''' Serve the ESP status as Prometheus metrics on this port. The
+    exporter scrapes /nginx_status and /endpoints_status from the status
+    port. Default: not used.''')
+
+    parser.add_argument('--status_exporter_interval',
+    default=DEFAULT_STATUS_EXPORTER_INTERVAL, type=float, help=''' Seconds
+    between scrapes of the status port by the status exporter. Default value:
+    {interval}.'''.format(interval=DEFAULT_STATUS_EXPORTER_INTERVAL))
+
     parser.add_argument('-a', '--backend', default=DEFAULT_BACKEND, help='''
     Change the application server address to which ESP proxies the requests.
     Default value: {backend}. For HTTPS backends, please use "https://" prefix,
@@ -453,18 +1156,148 @@ config file.'''.format(
     example, "-z healthz" makes ESP return code 200 for location "/healthz",
     instead of forwarding the request to the backend.  Default: not used.''')
 
+    parser.add_argument('--services_file', default=None, help='''
+    Front several Endpoints services with one ESP. The file contains a JSON
+    list with one object per service, with key "service" and optional keys
+    "version", "rollout_strategy", "service_config_url", "http_port",
+    "http2_port", "ssl_port", "host" and "backend", which have the same
+    meaning as the flags of the same name. "host" sets the server name, so
+    that services can share a port. The service configs are fetched
+    concurrently and each service gets its own server block and server
+    config. Flags not listed apply to all services.''')
+
     parser.add_argument('-R', '--rollout_strategy',
         default=None,
         help='''The service config rollout strategy, [fixed|managed],
         Default value: {strategy}'''.format(strategy=DEFAULT_ROLLOUT_STRATEGY),
         choices=['fixed', 'managed'])
 
+    parser.add_argument('--config_history',
+        default=config_store.DEFAULT_HISTORY, type=int, help='''
+        Number of previously fetched service configs kept in the config
+        directory besides the configs of the current rollout. Configs are
+        stored once per content, older ones are deleted at start-up.
+        Default value: {history}'''.format(history=config_store.DEFAULT_HISTORY))
+
     parser.add_argument('-x', '--xff_trusted_proxy_list',
         default=DEFAULT_XFF_TRUSTED_PROXY_LIST,
         help='''Comma separated list of trusted proxy for X-Forwarded-For
         header, Default value: {xff_trusted_proxy_list}'''.
         format(xff_trusted_proxy_list=DEFAULT_XFF_TRUSTED_PROXY_LIST))
 
+    parser.add_argument('--rate_limit', default=None, type=int, help='''
+    Limit the request rate of each client address to this many requests per
+    second. Requests over the limit and the burst are rejected by nginx with
+    the overload status before they are proxied. The health check endpoint
+    and the status port are exempt. The client address is taken from
+    X-Forwarded-For if the peer is in --xff_trusted_proxy_list. With the
+    default list every peer is trusted, so clients can spoof the header to
+    bypass the limit; set the list to the load balancers in front of ESP.
+    Default: not used.''')
+
+    parser.add_argument('--rate_limit_burst', default=0, type=int, help='''
+    Number of requests per client address over the rate limit that are
+    queued and delayed to the limit instead of rejected. Default value: 0.''')
+
+    parser.add_argument('--global_rate_limit', default=None, type=int,
+    help='''Limit the request rate of all clients together to this many
+    requests per second, like --rate_limit. Default: not used.''')
+
+    parser.add_argument('--global_rate_limit_burst', default=0, type=int,
+    help='''Number of requests over the global rate limit that are queued
+    and delayed to the limit instead of rejected. Default value: 0.''')
+
+    parser.add_argument('--overload_status', default=DEFAULT_OVERLOAD_STATUS,
+    type=int, choices=[429, 503], help='''Status code of requests rejected by
+    the rate limits. Default value: {status}.'''.format(
+        status=DEFAULT_OVERLOAD_STATUS))
+
+    parser.add_argument('--backend_max_conns', default=None, type=int,
+    help='''Limit the number of simultaneous connections to each backend
+    server of an HTTP or HTTPS backend, including idle keepalive
+    connections. nginx fails requests over the limit with 502 instead of
+    queueing them. Default: not used.''')
+
+    parser.add_argument('--backend_dns_ttl', default=None, type=int, help='''
+    Resolve hostname backends at request time and cache the addresses for
+    this many seconds, so that ESP follows backend IP changes without a
+    restart. Uses the nameservers of {resolv_conf}, which do not see
+    /etc/hosts. Names without a dot are qualified with the first search domain
+    there, other names must be fully qualified. Connections to such backends
+    are not kept alive. Default: not
+    used, backends are resolved once at start-up.'''.format(
+        resolv_conf=RESOLV_CONF))
+
+    parser.add_argument('--backend_ready_timeout', default=None, type=float,
+    help='''Before starting nginx, wait up to this many seconds for all
+    backends to accept connections, and for HTTPS backends to complete a TLS
+    handshake. Once nginx runs, warm-up requests open keepalive connections
+    to the backends, and /healthz on the status port returns 503 until the
+    warm-up is done. Backends that are not ready by the deadline are logged
+    and ESP starts regardless. Default: not used, nginx starts right
+    away.''')
+
+    parser.add_argument('--backend_warmup_path',
+    default=DEFAULT_BACKEND_WARMUP_PATH, help='''Request path of the warm-up
+    requests to the backends with --backend_ready_timeout. Any response
+    keeps the connection open, so a cheap path such as a health check is
+    best. Default value: {path}.'''.format(path=DEFAULT_BACKEND_WARMUP_PATH))
+
+    parser.add_argument('--gzip_level', default=None, type=int,
+    choices=range(1, 10), metavar='{1..9}', help='''Compress responses with
+    gzip at this level, 1 is the fastest and 9 the smallest. Responses that
+    are compressed by the backend already and gRPC responses are passed
+    through. Default: not used.''')
+
+    parser.add_argument('--gzip_min_length', default=DEFAULT_GZIP_MIN_LENGTH,
+    type=int, help='''Minimum length in bytes of compressed responses, by
+    their Content-Length. Default value: {length}.'''.format(
+        length=DEFAULT_GZIP_MIN_LENGTH))
+
+    parser.add_argument('--gzip_types', default=DEFAULT_GZIP_TYPES, help='''
+    Comma separated list of MIME types of compressed responses, text/html is
+    always compressed. Types that are compressed already, such as images,
+    and gRPC are skipped. Default value: {types}.'''.format(
+        types=DEFAULT_GZIP_TYPES))
+
+    parser.add_argument('--gzip_proxied', default=DEFAULT_GZIP_PROXIED,
+    type=gzip_proxied, help='''Comma separated list of conditions under which
+    responses to requests from proxies, which carry a Via header such as
+    requests from Google Cloud load balancers, are compressed. Takes the
+    values of the nginx gzip_proxied directive. Default value:
+    {proxied}.'''.format(proxied=DEFAULT_GZIP_PROXIED))
+
+    parser.add_argument('--gzip_static', action='store_true', help='''Serve
+    precompressed .gz variants of files served by locations in
+    /var/lib/nginx/extra/*.conf to clients accepting gzip. Requires nginx
+    with the gzip_static module.''')
+
+    parser.add_argument('--cache_route', default=None, type=cache_route,
+    action='append', metavar='PREFIX=SECONDS|SELECTOR=SECONDS', help='''
+    Cache successful GET responses of the backend for this many seconds.
+    PREFIX is a request path prefix such as /v1/shelves. SELECTOR is a
+    method selector of the service config such as
+    endpoints.examples.bookstore.Bookstore.ListShelves, or a pattern such as
+    endpoints.examples.bookstore.Bookstore.Get*, whose GET HTTP rules are
+    cached. Cache-Control and Expires headers of the backend take precedence.
+    Responses are cached per Authorization and X-API-Key header. Stale
+    responses are served while one request refreshes them, and concurrent
+    misses are collapsed into one backend request. May be repeated. Default:
+    no caching.''')
+
+    parser.add_argument('--cache_path', default=DEFAULT_CACHE_PATH, help='''
+    Directory of the response cache. nginx creates it, its parent directory
+    is created before nginx starts. Default value:
+    {path}.'''.format(path=DEFAULT_CACHE_PATH))
+
+    parser.add_argument('--cache_max_size', default=DEFAULT_CACHE_MAX_SIZE,
+    help='''Maximum size of the response cache on disk, e.g. 512m or 2g.
+    Default value: {size}.'''.format(size=DEFAULT_CACHE_MAX_SIZE))
+
+    parser.add_argument('--cache_zone_size', default=DEFAULT_CACHE_ZONE_SIZE,
+    help='''Size of the shared memory for cache keys, about 8000 keys per
+    megabyte. Default value: {size}.'''.format(size=DEFAULT_CACHE_ZONE_SIZE))
+
     parser.add_argument('--check_metadata', action='store_true',
         help='''Enable fetching access token, service name, service config ID
         and rollout strategy from the metadata service''')
@@ -497,7 +1330,8 @@ config file.'''.format(
         help=argparse.SUPPRESS)
 
     # Fetched service config and generated nginx config are placed
-    # into config_dir as service.json and nginx.conf files
+    # into config_dir as service.json and nginx.conf files. Configs of
+    # rollouts are stored by content hash, see config_store.py.
     parser.add_argument('--config_dir',
         default=CONFIG_DIR,
         help=argparse.SUPPRESS)
@@ -518,9 +1352,15 @@ config file.'''.format(
         default=NGINX,
         help=argparse.SUPPRESS)
 
-    # Address of the DNS resolver used by nginx http.cc
+    # Address of the DNS resolver used by nginx http.cc. Defaults to the
+    # first nameserver in resolv.conf.
     parser.add_argument('--dns',
-        default=DNS_RESOLVER,
+        default=None,
+        help=argparse.SUPPRESS)
+
+    # System resolver configuration with nameservers and search domains.
+    parser.add_argument('--resolv_conf',
+        default=RESOLV_CONF,
         help=argparse.SUPPRESS)
 
     # Access log destination. Use special value 'off' to disable.
@@ -533,6 +1373,23 @@ config file.'''.format(
         default=DEFAULT_PID_FILE,
         help=argparse.SUPPRESS)
 
+    # Number of nginx worker processes, a number or "auto".
+    parser.add_argument('--worker_processes',
+        default=DEFAULT_WORKER_PROCESSES,
+        help=argparse.SUPPRESS)
+
+    # Idle keepalive connections to the backend per worker. Use 0 to disable.
+    parser.add_argument('--upstream_keepalive',
+        default=DEFAULT_UPSTREAM_KEEPALIVE,
+        type=int,
+        help=argparse.SUPPRESS)
+
+    # Concurrent warm-up requests per backend with --backend_ready_timeout.
+    parser.add_argument('--backend_warmup_connections',
+        default=DEFAULT_BACKEND_WARMUP_CONNECTIONS,
+        type=int,
+        help=argparse.SUPPRESS)
+
     return parser
 
 
@@ -552,25 +1409,49 @@ if __name__ == '__main__':
     # Handles IP addresses of trusted proxies
     handle_xff_trusted_proxies(args)
 
-    # Get service config
-    if args.service_json_path:
-        assert_file_exists(args.service_json_path)
-        args.service_configs = {args.service_json_path: 100}
+    # Handles DNS servers and search domains
+    handle_dns(args)
+
+    if args.services_file:
+        # Fetch service configs and generate server_config for each service
+        services = load_services(args)
+        bootstrap_services(args, services)
     else:
-        # Fetch service config and place it in the standard location
-        ensure(args.config_dir)
-        fetch_service_config(args)
+        # Get service config
+        if args.service_json_path:
+            assert_file_exists(args.service_json_path)
+            args.service_configs = {args.service_json_path: 100}
+        else:
+            # Fetch service config and place it in the standard location
+            ensure(args.config_dir)
+            fetch_service_config(args)
 
-    # Generate server_config
-    write_server_config_templage(SERVER_CONF, args)
+        # Generate server_config
+        write_server_config_templage(SERVER_CONF, args)
 
     # Generate nginx config if not specified
     nginx_conf = args.nginx_config
     if nginx_conf is None:
-        ingress = make_ingress(args)
+        if args.services_file:
+            ingresses = make_service_ingresses(args, services)
+        else:
+            ingresses = [make_ingress(args)]
         nginx_conf = args.config_dir + "/nginx.conf"
         ensure(args.config_dir)
-        write_template(ingress, nginx_conf, args)
+        # nginx creates only the last component of the cache path
+        if any(ingress.cache_routes for ingress in ingresses):
+            ensure(os.path.dirname(os.path.normpath(args.cache_path)))
+        write_template(ingresses, nginx_conf, args)
+
+    # Wait for the backends and warm up the connections to them
+    if args.backend_ready_timeout is not None and args.nginx_config is None:
+        if not wait_for_backends(ingresses, args.backend_ready_timeout):
+            logging.warning("Starting before all backends are ready")
+        start_backend_warmup(args, ingresses)
+
+    # Start the status exporter next to NGINX
+    if args.status_exporter_port is not None:
+        start_status_exporter(args)
 
     # Start NGINX
     start_nginx(args.nginx, nginx_conf)
@@ -0,0 +1,354 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Prometheus exporter for the ESP status server.
+# Scrapes /nginx_status and /endpoints_status on the ESP status port over one
+# persistent connection and serves the latest scrape as Prometheus text
+# format metrics on a separate port.
+
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+# Default ESP status port
+DEFAULT_STATUS_PORT = 8090
+
+# Default port of the exporter
+DEFAULT_EXPORTER_PORT = 9145
+
+# Default seconds between scrapes of the status server
+DEFAULT_INTERVAL = 10
+
+NGINX_STATUS_PATH = "/nginx_status"
+ENDPOINTS_STATUS_PATH = "/endpoints_status"
+METRICS_PATH = "/metrics"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Fields of /endpoints_status that identify an entry and become labels
+_ENDPOINTS_STATUS_LABELS = ("processId", "serviceName", "serviceConfigId")
+
+_NGINX_STATUS_RE = re.compile(
+    r"Active connections:\s*(?P<active>\d+)\s+"
+    r"server accepts handled requests\s+"
+    r"(?P<accepted>\d+)\s+(?P<handled>\d+)\s+(?P<requests>\d+)\s+"
+    r"Reading:\s*(?P<reading>\d+)\s+"
+    r"Writing:\s*(?P<writing>\d+)\s+"
+    r"Waiting:\s*(?P<waiting>\d+)")
+
+# (name, type, help, field) of the metrics parsed from /nginx_status
+_NGINX_METRICS = [
+    ("nginx_connections_active", "gauge",
+     "Active client connections including waiting connections.", "active"),
+    ("nginx_connections_reading", "gauge",
+     "Connections reading the request header.", "reading"),
+    ("nginx_connections_writing", "gauge",
+     "Connections writing the response.", "writing"),
+    ("nginx_connections_waiting", "gauge",
+     "Idle keepalive client connections.", "waiting"),
+    ("nginx_connections_accepted_total", "counter",
+     "Accepted client connections.", "accepted"),
+    ("nginx_connections_handled_total", "counter",
+     "Handled client connections.", "handled"),
+    ("nginx_http_requests_total", "counter",
+     "Client requests.", "requests"),
+]
+
+
+class Metric(object):
+    """A metric family with its samples, as (labels, value) pairs."""
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.samples = []
+
+
+def parse_nginx_status(text):
+    """Parse stub_status output into a dict of integer fields."""
+    match = _NGINX_STATUS_RE.search(text)
+    if match is None:
+        raise ValueError("Unexpected nginx status: " + repr(text[:200]))
+    return dict((key, int(value))
+                for key, value in match.groupdict().iteritems())
+
+
+def _snake_case(name):
+    name = re.sub(r"([a-z0-9])([A-Z])", r"\1_\2", name)
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name).lower()
+
+
+def _number(value):
+    # bool is a subclass of int, proto3 JSON encodes int64 as strings
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _with_label(labels, label, value):
+    # A nested identifier replaces the one of its parent with the same name
+    if any(name == label for name, _ in labels):
+        return [(name, value if name == label else old_value)
+                for name, old_value in labels]
+    return labels + [(label, value)]
+
+
+def _flatten(value, name, labels, samples, index_label="index"):
+    if isinstance(value, dict):
+        for key in _ENDPOINTS_STATUS_LABELS:
+            if key in value and not isinstance(value[key], (dict, list)):
+                labels = _with_label(labels, _snake_case(key),
+                                     unicode(value[key]))
+        for key in sorted(value):
+            if key not in _ENDPOINTS_STATUS_LABELS:
+                _flatten(value[key], name + "_" + _snake_case(key),
+                         labels, samples, _snake_case(key) + "_index")
+    elif isinstance(value, list):
+        # Items without identifiers are told apart by their position
+        for index, item in enumerate(value):
+            if isinstance(item, dict) and any(
+                    key in item for key in _ENDPOINTS_STATUS_LABELS):
+                _flatten(item, name, labels, samples)
+            else:
+                _flatten(item, name,
+                         _with_label(labels, index_label, unicode(index)),
+                         samples)
+    else:
+        number = _number(value)
+        if number is not None:
+            samples.append((name, tuple(labels), number))
+
+
+def parse_endpoints_status(text):
+    """Parse /endpoints_status JSON into (name, labels, value) samples.
+
+    Every numeric leaf becomes a sample named after its path. Process and
+    service identifiers found along the path become labels, the innermost
+    one wins if a name repeats. List items without identifiers are labeled
+    with their position, e.g. latencies_index for items of "latencies".
+    """
+    try:
+        status = json.loads(text)
+    except ValueError:
+        raise ValueError("Unexpected endpoints status: " + repr(text[:200]))
+    samples = []
+    _flatten(status, "esp", [], samples)
+    return samples
+
+
+def make_metrics(nginx_status, endpoints_status):
+    """Build metric families from parsed status, None for failed scrapes."""
+    metrics = []
+
+    up = Metric("nginx_up", "gauge",
+                "Whether the last scrape of /nginx_status succeeded.")
+    up.samples.append(((), 0 if nginx_status is None else 1))
+    metrics.append(up)
+    if nginx_status is not None:
+        for name, metric_type, help_text, field in _NGINX_METRICS:
+            metric = Metric(name, metric_type, help_text)
+            metric.samples.append(((), nginx_status[field]))
+            metrics.append(metric)
+
+    up = Metric("esp_up", "gauge",
+                "Whether the last scrape of /endpoints_status succeeded.")
+    up.samples.append(((), 0 if endpoints_status is None else 1))
+    metrics.append(up)
+    families = {}
+    for name, labels, value in endpoints_status or []:
+        if name not in families:
+            families[name] = Metric(name, "untyped",
+                                    "ESP status field " + name[4:] + ".")
+            metrics.append(families[name])
+        families[name].samples.append((labels, value))
+
+    return metrics
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_metrics(metrics):
+    """Render metric families in the Prometheus text exposition format."""
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for labels, value in metric.samples:
+            if labels:
+                label_text = "{" + ",".join(
+                    u'{}="{}"'.format(label, _escape(label_value))
+                    for label, label_value in labels) + "}"
+            else:
+                label_text = ""
+            lines.append(u"{}{} {}".format(metric.name, label_text, value))
+    return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+class StatusClient(object):
+    """Fetches status pages over one persistent HTTP connection."""
+    def __init__(self, host, port, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+
+    def get(self, path):
+        # Reconnect once if nginx closed the idle connection
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = httplib.HTTPConnection(self.host, self.port,
+                                                   timeout=self.timeout)
+            try:
+                self.conn.request("GET", path)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise httplib.HTTPException(
+                    "Fetching {} failed (status code {})".format(
+                        path, response.status))
+            return data
+
+
+class Exporter(object):
+    """Scrapes the status server periodically and keeps the latest metrics."""
+    def __init__(self, status_host, status_port, interval):
+        self.client = StatusClient(status_host, status_port)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.metrics = format_metrics(make_metrics(None, None))
+
+    def scrape(self):
+        nginx_status = None
+        try:
+            nginx_status = parse_nginx_status(
+                self.client.get(NGINX_STATUS_PATH))
+        except (httplib.HTTPException, socket.error, ValueError) as err:
+            logging.warning("Failed to scrape nginx status: %s", err)
+
+        endpoints_status = None
+        try:
+            endpoints_status = parse_endpoints_status(
+                self.client.get(ENDPOINTS_STATUS_PATH))
+        except (httplib.HTTPException, socket.error, ValueError) as err:
+            logging.warning("Failed to scrape endpoints status: %s", err)
+
+        metrics = format_metrics(make_metrics(nginx_status, endpoints_status))
+        with self.lock:
+            self.metrics = metrics
+
+    def scrape_forever(self, parent_pid=None):
+        # Stop if the supervising process is gone, see start_esp.py
+        while parent_pid is None or os.getppid() == parent_pid:
+            self.scrape()
+            time.sleep(self.interval)
+        os._exit(0)
+
+    def get_metrics(self):
+        with self.lock:
+            return self.metrics
+
+
+def make_handler(exporter):
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = exporter.get_metrics()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def run(status_port, port, interval=DEFAULT_INTERVAL,
+        status_host="127.0.0.1", parent_pid=None):
+    """Serve metrics on port until the process is killed.
+
+    If parent_pid is set, the exporter exits once it is no longer the parent
+    of the process.
+    """
+    exporter = Exporter(status_host, status_port, interval)
+    scraper = threading.Thread(target=exporter.scrape_forever,
+                               args=(parent_pid,))
+    scraper.daemon = True
+    scraper.start()
+    server = BaseHTTPServer.HTTPServer(("", port), make_handler(exporter))
+    server.serve_forever()
+
+
+def make_argparser():
+    parser = argparse.ArgumentParser(description='''
+    Prometheus exporter for the ESP status server. Scrapes {nginx_status} and
+    {endpoints_status} on the ESP status port and serves them as metrics on
+    {metrics_path}.'''.format(nginx_status=NGINX_STATUS_PATH,
+                              endpoints_status=ENDPOINTS_STATUS_PATH,
+                              metrics_path=METRICS_PATH))
+
+    parser.add_argument('-N', '--status_port', default=DEFAULT_STATUS_PORT,
+    type=int, help='''ESP status port. Default value:
+    {port}.'''.format(port=DEFAULT_STATUS_PORT))
+
+    parser.add_argument('--status_host', default="127.0.0.1", help='''ESP
+    status server host. Default value: 127.0.0.1.''')
+
+    parser.add_argument('-p', '--port', default=DEFAULT_EXPORTER_PORT,
+    type=int, help='''Port to serve metrics on. Default value:
+    {port}.'''.format(port=DEFAULT_EXPORTER_PORT))
+
+    parser.add_argument('-i', '--interval', default=DEFAULT_INTERVAL,
+    type=float, help='''Seconds between scrapes of the status server.
+    Default value: {interval}.'''.format(interval=DEFAULT_INTERVAL))
+
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_argparser().parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    run(args.status_port, args.port, args.interval, args.status_host)
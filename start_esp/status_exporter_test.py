@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Parser tests of the status exporter against captured status pages in
+# testdata/. metrics.txt is the expected exposition of both pages.
+
+import os
+import unittest
+
+import status_exporter
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "testdata")
+
+
+def read_testdata(name):
+    with open(os.path.join(TESTDATA, name)) as f:
+        return f.read()
+
+
+def series(samples):
+    return [(name, labels) for name, labels, _ in samples]
+
+
+class ParseNginxStatusTest(unittest.TestCase):
+    def test_captured(self):
+        status = status_exporter.parse_nginx_status(
+            read_testdata("nginx_status.txt"))
+        self.assertEqual(status, {
+            "active": 3,
+            "accepted": 1024,
+            "handled": 1024,
+            "requests": 2048,
+            "reading": 0,
+            "writing": 1,
+            "waiting": 2,
+        })
+
+    def test_unexpected(self):
+        self.assertRaises(ValueError, status_exporter.parse_nginx_status,
+                          "<html>Not Found</html>")
+
+
+class ParseEndpointsStatusTest(unittest.TestCase):
+    def test_captured(self):
+        samples = status_exporter.parse_endpoints_status(
+            read_testdata("endpoints_status.json"))
+        self.assertIn(
+            ("esp_processes_esp_status_statistics_total_called_checks",
+             (("service_name", "echo-api.endpoints.my-project.cloud.goog"),
+              ("process_id", "8"),
+              ("service_config_id", "2017-05-01r0")),
+             97),
+            samples)
+        self.assertIn(
+            ("esp_processes_memory_usage_max_rss_kb",
+             (("service_name", "echo-api.endpoints.my-project.cloud.goog"),
+              ("process_id", "7")),
+             24560),
+            samples)
+        # serverVersion is not a number
+        self.assertEqual(len(samples), 16)
+
+    def test_series_are_unique(self):
+        samples = status_exporter.parse_endpoints_status(
+            read_testdata("endpoints_status.json"))
+        self.assertEqual(len(set(series(samples))), len(samples))
+
+    def test_nested_label_overrides_parent(self):
+        samples = status_exporter.parse_endpoints_status("""{
+            "serviceName": "outer",
+            "espStatus": [{"serviceName": "inner", "requests": 1}]
+        }""")
+        self.assertEqual(samples, [
+            ("esp_esp_status_requests", (("service_name", "inner"),), 1)])
+
+    def test_scalar_list_items_are_indexed(self):
+        samples = status_exporter.parse_endpoints_status(
+            '{"processId": "7", "latencies": [1, 2]}')
+        self.assertEqual(samples, [
+            ("esp_latencies",
+             (("process_id", "7"), ("latencies_index", "0")), 1),
+            ("esp_latencies",
+             (("process_id", "7"), ("latencies_index", "1")), 2),
+        ])
+
+    def test_anonymous_list_items_are_indexed(self):
+        samples = status_exporter.parse_endpoints_status(
+            '{"buckets": [{"count": 1, "sizes": [3]},'
+            ' {"count": 2, "sizes": [4]}]}')
+        self.assertEqual(len(set(series(samples))), 4)
+        self.assertIn(
+            ("esp_buckets_sizes",
+             (("buckets_index", "1"), ("sizes_index", "0")), 4),
+            samples)
+
+    def test_unexpected(self):
+        self.assertRaises(ValueError, status_exporter.parse_endpoints_status,
+                          "<html>Not Found</html>")
+
+
+class FormatMetricsTest(unittest.TestCase):
+    def test_captured(self):
+        metrics = status_exporter.make_metrics(
+            status_exporter.parse_nginx_status(
+                read_testdata("nginx_status.txt")),
+            status_exporter.parse_endpoints_status(
+                read_testdata("endpoints_status.json")))
+        self.assertEqual(status_exporter.format_metrics(metrics),
+                         read_testdata("metrics.txt"))
+
+    def test_failed_scrapes(self):
+        text = status_exporter.format_metrics(
+            status_exporter.make_metrics(None, None))
+        self.assertEqual(text, "\n".join([
+            "# HELP nginx_up Whether the last scrape of /nginx_status "
+            "succeeded.",
+            "# TYPE nginx_up gauge",
+            "nginx_up 0",
+            "# HELP esp_up Whether the last scrape of /endpoints_status "
+            "succeeded.",
+            "# TYPE esp_up gauge",
+            "esp_up 0",
+            ""]))
+
+    def test_escapes_label_values(self):
+        metric = status_exporter.Metric("esp_requests", "untyped", "Requests.")
+        metric.samples.append(((("service_name", u'a"b\\c\nd'),), 1))
+        self.assertEqual(
+            status_exporter.format_metrics([metric]).splitlines()[-1],
+            'esp_requests{service_name="a\\"b\\\\c\\nd"} 1')
+
+
+if __name__ == '__main__':
+    unittest.main()